@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Benchmark the calibration time of z_calibration.py in the simulator.
+#
+# Copyright (C) 2021-2025  Titus Meyer <info@protoloft.org>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Runs a set of configuration scenarios through the fake Klipper in
+# sim_klippy.py and reports the simulated time, move count and probe count
+# per command. Use -c to add config options to every scenario, e.g.:
+#   ./scripts/benchmark.py -c samples=3 -c probing_first_fast=True
+import optparse, sys, os, logging
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sim_klippy
+
+# name, config options, simulation options, commands
+SCENARIOS = [
+    ("default", {}, {}, ["CALIBRATE_Z"]),
+    ("first_fast", {'probing_first_fast': 'True'}, {}, ["CALIBRATE_Z"]),
+    ("wiggle", {'wiggle_xy_offsets': '1.0,1.0'}, {}, ["CALIBRATE_Z"]),
+    ("short_retract", {'probing_retract_dist': '1.0'}, {},
+     ["CALIBRATE_Z"]),
+    ("adaptive_retract", {'probing_retract_min_dist': '0.5',
+                          'wiggle_xy_offsets': '1.0,1.0',
+                          'wiggle_threshold': '0.003'}, {},
+     ["CALIBRATE_Z"]),
+    ("ci_target", {'samples_ci_target': '0.003'}, {}, ["CALIBRATE_Z"]),
+    ("outliers", {}, {'outlier_rate': 0.1}, ["CALIBRATE_Z"]),
+    ("outliers_mad", {'samples_result': 'mad'}, {'outlier_rate': 0.1},
+     ["CALIBRATE_Z"]),
+    ("combined_travel", {'combine_lift_travel': 'True',
+                         'combine_lift_min_z': '10.0'}, {},
+     ["CALIBRATE_Z"]),
+    ("approach", {'approach_margin': '1.0'}, {},
+     ["CALIBRATE_Z", "G28\nCALIBRATE_Z"]),
+    ("mesh_reuse", {'bed_mesh_max_age': '600', 'end_gcode': ''}, {},
+     ["SIM_ATTACH_PROBE\nBED_MESH_CALIBRATE", "CALIBRATE_Z"]),
+    ("homing_sample", {'homing_trigger_max_age': '60'}, {},
+     ["CALIBRATE_Z"]),
+    ("docked", {'start_gcode': 'SIM_DETACH_PROBE'},
+     {'dock_site': (250., 300.)},
+     ["SIM_ATTACH_PROBE\nCALIBRATE_Z"]),
+    ("attached_first", {'before_nozzle_gcode': 'SIM_DETACH_PROBE'},
+     {'dock_site': (250., 300.)}, ["SIM_ATTACH_PROBE\nCALIBRATE_Z"]),
+    ("cached", {}, {}, ["CALIBRATE_Z", "CALIBRATE_Z CACHE=1"]),
+    ("verify", {}, {}, ["CALIBRATE_Z", "CALIBRATE_Z VERIFY=1"]),
+    ("verify_approach", {'approach_margin': '1.0'}, {},
+     ["CALIBRATE_Z", "CALIBRATE_Z VERIFY=1"]),
+    ("partial", {}, {}, ["CALIBRATE_Z", "CALIBRATE_Z SITES=nozzle"]),
+    ("soak", {}, {'soak': (0.05, 300.)}, ["CALIBRATE_Z SOAK=1"]),
+    ("accuracy", {}, {}, ["PROBE_Z_ACCURACY SAMPLES=10"]),
+    ("tune_speed", {'samples_tolerance': '0.012'}, {'speed_noise': 0.1},
+     ["TUNE_PROBING_SPEED SAVE=1"]),
+    ("tools", {}, {'extra_sections': {
+        'z_calibration T0': {}, 'z_calibration T1': {}}},
+     ["CALIBRATE_Z_TOOLS"]),
+]
+
+def run_scenario(config, sim_options, commands, seed):
+    sim = sim_klippy.Simulation(config=config, seed=seed, **sim_options)
+    sim.home()
+    results = []
+    for command in commands:
+        sim.reset_stats()
+        try:
+            sim.run(command)
+            error = None
+        except sim_klippy.CommandError as e:
+            error = str(e)
+        results.append((command, sim.stats(), error))
+    return results
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--config", action="append", default=[],
+                    help="add a config option (name=value) to all scenarios")
+    opts.add_option("-s", "--seeds", type="int", default=5,
+                    help="number of random seeds per scenario")
+    opts.add_option("-n", "--noise", type="float", default=0.002,
+                    help="standard deviation of the probe noise in mm")
+    opts.add_option("-a", "--api", default="current",
+                    help="simulated Klipper API: current, wrapped or legacy")
+    opts.add_option("-f", "--filter", default="",
+                    help="only run scenarios containing this name")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    overrides = {}
+    for option in options.config:
+        name, sep, value = option.partition('=')
+        if not sep:
+            opts.error("Invalid config option: %s" % (option,))
+        overrides[name.strip()] = value.strip()
+    print("%-16s %-28s %9s %7s %7s %6s"
+          % ("scenario", "command", "time[s]", "moves", "probes", "errors"))
+    for name, config, sim_options, commands in SCENARIOS:
+        if options.filter not in name:
+            continue
+        config = dict(config, **overrides)
+        sim_options = dict(sim_options, noise=options.noise, api=options.api)
+        totals = [[0., 0, 0, 0] for command in commands]
+        for seed in range(1, options.seeds + 1):
+            results = run_scenario(config, sim_options, commands, seed)
+            for total, (command, stats, error) in zip(totals, results):
+                total[0] += stats['time']
+                total[1] += stats['moves']
+                total[2] += stats['probes']
+                total[3] += error is not None
+        for command, total in zip(commands, totals):
+            count = float(options.seeds)
+            command = command.replace('\n', '; ')
+            print("%-16s %-28s %9.2f %7.1f %7.1f %6d"
+                  % (name, command, total[0] / count, total[1] / count,
+                     total[2] / count, total[3]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Check z_calibration.py against the simulated Klipper API generations.
+#
+# Copyright (C) 2021-2025  Titus Meyer <info@protoloft.org>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Loads the plugin in sim_klippy.py once per supported Klipper API, checks
+# what KlipperAdapter bound at connect and runs the commands depending on
+# it. Exits with an error if any check fails, e.g.:
+#   ./scripts/check_api.py -a legacy
+import optparse, sys, os, logging
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sim_klippy
+
+APIS = ["current", "wrapped", "legacy"]
+
+def check_adapter(api):
+    sim = sim_klippy.Simulation(api=api)
+    adapter = sim.helper.adapter
+    probe = sim.probe
+    failures = []
+    def check(name, passed):
+        if not passed:
+            failures.append(name)
+    # probe sessions of the new probe API or the legacy multi_probe_*
+    adapter.start_probe_session()
+    check("start_probe_session", probe.sessions == 1)
+    adapter.end_probe_session()
+    check("end_probe_session", probe.sessions == 0)
+    # the MCU endstop, also when nested inside ProbeEndstopWrapper
+    check("probe_endstop",
+          isinstance(adapter.probe_endstop, sim_klippy.SimEndstop))
+    check("query_probe", adapter.query_probe(0.) in (True, False))
+    # the bed mesh zero reference and probe points helper
+    bed_mesh = sim.printer.lookup_object('bed_mesh')
+    check("get_mesh_zero_ref_pos",
+          adapter.get_mesh_zero_ref_pos() == bed_mesh.zero_ref_pos)
+    check("mesh_probe_helper",
+          adapter.mesh_probe_helper is bed_mesh.probe_helper)
+    params = adapter.get_probe_params()
+    check("get_probe_params", params.get('z_offset') == probe.offsets[2]
+          and params.get('samples') == probe.params['samples'])
+    return failures
+
+def check_commands(api):
+    failures = []
+    # a full calibration
+    sim = sim_klippy.Simulation(api=api)
+    sim.home()
+    try:
+        sim.run("CALIBRATE_Z")
+    except sim_klippy.CommandError as e:
+        failures.append("CALIBRATE_Z: %s" % (e,))
+    else:
+        if not sim.helper.last_state:
+            failures.append("CALIBRATE_Z: no offset")
+    # the bed site reused from a fresh bed mesh
+    sim = sim_klippy.Simulation(api=api, config={'bed_mesh_max_age': '600',
+                                                 'end_gcode': ''})
+    sim.home()
+    gcode = sim.printer.lookup_object('gcode')
+    try:
+        sim.run("SIM_ATTACH_PROBE\nBED_MESH_CALIBRATE")
+        sim.run("CALIBRATE_Z")
+    except sim_klippy.CommandError as e:
+        failures.append("bed mesh reuse: %s" % (e,))
+    else:
+        if not [msg for msg in gcode.responses
+                if "using the bed mesh probe result" in msg]:
+            failures.append("bed mesh reuse: mesh result not used")
+    return failures
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-a", "--api", action="append", default=[],
+                    help="simulated Klipper API to check, default all")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    for api in options.api:
+        if api not in APIS:
+            opts.error("Unknown API: %s" % (api,))
+    logging.basicConfig(level=logging.WARNING)
+    failed = False
+    for api in options.api or APIS:
+        failures = check_adapter(api) + check_commands(api)
+        for failure in failures:
+            print("%-8s FAIL %s" % (api, failure))
+        if not failures:
+            print("%-8s ok" % (api,))
+        failed = failed or bool(failures)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
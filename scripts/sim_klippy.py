@@ -0,0 +1,804 @@
+# Offline simulation harness for the z_calibration plugin.
+#
+# Copyright (C) 2021-2025  Titus Meyer <info@protoloft.org>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Provides just enough of a fake Klipper (printer, config, gcode, toolhead,
+# homing, probe and endstops) to load z_calibration.py without hardware.
+# Moves and probing moves are timed with a simple trapezoidal model, so the
+# simulated print time can be used to compare configurations.
+import sys, os, math, random, types, collections
+
+SENTINEL = object()
+
+######################################################################
+# Fake klippy modules
+######################################################################
+
+class MCU_endstop:
+    pass
+
+def install_modules():
+    if 'mcu' not in sys.modules:
+        mod = types.ModuleType('mcu')
+        mod.MCU_endstop = MCU_endstop
+        sys.modules['mcu'] = mod
+
+######################################################################
+# Errors, reactor and config
+######################################################################
+
+class CommandError(Exception):
+    pass
+
+class ConfigError(Exception):
+    pass
+
+class SimReactor:
+    NEVER = 9999999999999999.
+    NOW = 0.
+    def __init__(self):
+        self.now = 0.
+        self.timers = []
+    def monotonic(self):
+        return self.now
+    def advance(self, delay):
+        self.now += max(0., delay)
+        self._run_timers()
+    def pause(self, waketime):
+        if waketime > self.now:
+            self.now = waketime
+        self._run_timers()
+        return self.now
+    def register_timer(self, callback, waketime=NEVER):
+        timer = [callback, waketime]
+        self.timers.append(timer)
+        return timer
+    def update_timer(self, timer, waketime):
+        timer[1] = waketime
+    def unregister_timer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+    def register_callback(self, callback, waketime=NOW):
+        callback(self.now)
+    def _run_timers(self):
+        for timer in list(self.timers):
+            while timer in self.timers and timer[1] <= self.now:
+                timer[1] = timer[0](timer[1])
+
+class SimConfig:
+    error = ConfigError
+    def __init__(self, printer, name, options):
+        self.printer = printer
+        self.name = name
+        self.options = dict(options)
+        self.access_tracking = {}
+    def get_printer(self):
+        return self.printer
+    def get_name(self):
+        return self.name
+    def _get(self, name, default, parser):
+        if name not in self.options:
+            if default is SENTINEL:
+                raise ConfigError("Option '%s' in section '%s' must be"
+                                  " specified" % (name, self.name))
+            return default
+        value = self.options[name]
+        if isinstance(value, str):
+            value = parser(value)
+        return value
+    def _check(self, name, value, minval=None, maxval=None, above=None,
+               below=None):
+        if value is None:
+            return value
+        if minval is not None and value < minval:
+            raise ConfigError("Option '%s' must have minimum of %s"
+                              % (name, minval))
+        if maxval is not None and value > maxval:
+            raise ConfigError("Option '%s' must have maximum of %s"
+                              % (name, maxval))
+        if above is not None and value <= above:
+            raise ConfigError("Option '%s' must be above %s" % (name, above))
+        if below is not None and value >= below:
+            raise ConfigError("Option '%s' must be below %s" % (name, below))
+        return value
+    def get(self, name, default=SENTINEL):
+        return self._get(name, default, str)
+    def getfloat(self, name, default=SENTINEL, minval=None, maxval=None,
+                 above=None, below=None):
+        return self._check(name, self._get(name, default, float),
+                           minval, maxval, above, below)
+    def getint(self, name, default=SENTINEL, minval=None, maxval=None):
+        return self._check(name, self._get(name, default, int),
+                           minval, maxval)
+    def getboolean(self, name, default=SENTINEL):
+        return self._get(name, default,
+                         lambda v: v.strip().lower() in ('1', 'true', 'yes'))
+    def getchoice(self, name, choices, default=SENTINEL):
+        value = self.get(name, default)
+        if value not in choices:
+            raise ConfigError("Choice '%s' for option '%s' is not valid"
+                              % (value, name))
+        return choices[value]
+    def getlist(self, name, default=SENTINEL, sep=','):
+        value = self.get(name, default)
+        if value is None or isinstance(value, (list, tuple)):
+            return value
+        return tuple([v.strip() for v in value.split(sep) if v.strip()])
+    def get_prefix_sections(self, prefix):
+        return [s for n, s in sorted(self.printer.sections.items())
+                if n.startswith(prefix)]
+    def getsection(self, name):
+        return self.printer.sections.get(name, SimConfig(self.printer, name,
+                                                         {}))
+    def deprecate(self, option, value=None):
+        pass
+
+######################################################################
+# G-Code
+######################################################################
+
+class SimGCodeCommand:
+    def __init__(self, gcode, command, commandline, params):
+        self.gcode = gcode
+        self.command = command
+        self.commandline = commandline
+        self.params = dict((k.upper(), str(v)) for k, v in params.items())
+        self.error = gcode.error
+    def get_command(self):
+        return self.command
+    def get_commandline(self):
+        return self.commandline
+    def get_command_parameters(self):
+        return self.params
+    def respond_info(self, msg, log=True):
+        self.gcode.respond_info(msg, log)
+    def respond_raw(self, msg):
+        self.gcode.respond_raw(msg)
+    def get(self, name, default=SENTINEL, parser=str, minval=None,
+            maxval=None, above=None, below=None):
+        value = self.params.get(name)
+        if value is None:
+            if default is SENTINEL:
+                raise self.error("Error on '%s': missing %s"
+                                 % (self.commandline, name))
+            return default
+        try:
+            value = parser(value)
+        except Exception:
+            raise self.error("Unable to parse '%s' as a %s" % (value, name))
+        if minval is not None and value < minval:
+            raise self.error("Error on '%s': %s must have minimum of %s"
+                             % (self.commandline, name, minval))
+        if maxval is not None and value > maxval:
+            raise self.error("Error on '%s': %s must have maximum of %s"
+                             % (self.commandline, name, maxval))
+        if above is not None and value <= above:
+            raise self.error("Error on '%s': %s must be above %s"
+                             % (self.commandline, name, above))
+        if below is not None and value >= below:
+            raise self.error("Error on '%s': %s must be below %s"
+                             % (self.commandline, name, below))
+        return value
+    def get_int(self, name, default=SENTINEL, minval=None, maxval=None):
+        return self.get(name, default, parser=int, minval=minval,
+                        maxval=maxval)
+    def get_float(self, name, default=SENTINEL, minval=None, maxval=None,
+                  above=None, below=None):
+        return self.get(name, default, parser=float, minval=minval,
+                        maxval=maxval, above=above, below=below)
+
+class SimConfigFile:
+    def __init__(self):
+        self.changes = {}
+    def set(self, section, option, value):
+        self.changes.setdefault(section, {})[option] = value
+
+class SimMutex:
+    # held while a script runs, like the gcode mutex during a command
+    def __init__(self):
+        self.held = False
+    def test(self):
+        return self.held
+
+class SimGCode:
+    error = CommandError
+    def __init__(self, printer):
+        self.printer = printer
+        self.commands = {}
+        self.responses = []
+        self.echo = False
+        self.mutex = SimMutex()
+        self.pending = []
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        self.commands[cmd] = func
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+        if self.echo:
+            print("// " + msg.replace("\n", "\n// "))
+    def respond_raw(self, msg):
+        self.respond_info(msg)
+    def create_gcode_command(self, command, commandline, params):
+        return SimGCodeCommand(self, command, commandline, params)
+    def get_mutex(self):
+        return self.mutex
+    def run_script(self, script):
+        # a script from a timer waits for the running script to finish
+        if self.mutex.held:
+            self.pending.append(script)
+            return
+        self.mutex.held = True
+        try:
+            self.run_script_from_command(script)
+            while self.pending:
+                self.run_script_from_command(self.pending.pop(0))
+        finally:
+            self.mutex.held = False
+    def run_script_from_command(self, script):
+        for line in script.split('\n'):
+            line = line.split(';')[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            cmd = parts[0].upper()
+            params = {}
+            for part in parts[1:]:
+                if '=' in part:
+                    key, val = part.split('=', 1)
+                else:
+                    key, val = part[0], part[1:]
+                params[key.upper()] = val
+            self._dispatch(cmd, line, params)
+    def _dispatch(self, cmd, line, params):
+        toolhead = self.printer.lookup_object('toolhead')
+        if cmd in ('G0', 'G1'):
+            coord = [None, None, None]
+            for i, axis in enumerate('XYZ'):
+                if axis in params:
+                    coord[i] = float(params[axis])
+            speed = float(params.get('F', 60. * toolhead.max_velocity)) / 60.
+            toolhead.manual_move(coord, speed)
+        elif cmd == 'SET_GCODE_OFFSET':
+            self.printer.lookup_object('gcode_move').cmd_SET_GCODE_OFFSET(
+                self.create_gcode_command(cmd, line, params))
+        elif cmd == 'G4':
+            toolhead.dwell(float(params.get('P', 0.)) / 1000.)
+        elif cmd in ('SIM_ATTACH_PROBE', 'SIM_DETACH_PROBE'):
+            # like a dock macro checking its state: only travel to the dock
+            # if the probe state changes
+            world = self.printer.world
+            attach = cmd == 'SIM_ATTACH_PROBE'
+            if world.probe_attached != attach and world.dock_site:
+                toolhead.manual_move(list(world.dock_site) + [None],
+                                     toolhead.max_velocity)
+            world.probe_attached = attach
+        elif cmd in self.commands:
+            self.commands[cmd](self.create_gcode_command(cmd, line, params))
+        else:
+            raise self.error("Unknown command:\"%s\"" % (cmd,))
+
+class SimTemplate:
+    def __init__(self, printer, script):
+        self.printer = printer
+        self.script = script or ''
+        self.contexts = []
+    def create_template_context(self, eventtime=None):
+        return {}
+    def render(self, context=None):
+        return self.script
+    def run_gcode_from_command(self, context=None):
+        self.contexts.append(context)
+        if callable(self.script):
+            script = self.script(context or {})
+        else:
+            script = self.script
+        gcode = self.printer.lookup_object('gcode')
+        gcode.run_script_from_command(script)
+
+class SimGCodeMacro:
+    def __init__(self, printer):
+        self.printer = printer
+    def load_template(self, config, option, default=None):
+        return SimTemplate(self.printer, config.get(option, default))
+
+class SimGCodeMove:
+    def __init__(self, printer):
+        self.printer = printer
+        self.z_offset = 0.
+    def cmd_SET_GCODE_OFFSET(self, gcmd):
+        if 'Z' in gcmd.get_command_parameters():
+            self.z_offset = gcmd.get_float('Z')
+        if 'Z_ADJUST' in gcmd.get_command_parameters():
+            self.z_offset += gcmd.get_float('Z_ADJUST')
+    def get_status(self, eventtime=None):
+        return {'homing_origin': [0., 0., self.z_offset, 0.]}
+
+######################################################################
+# Motion
+######################################################################
+
+def move_time(dist, speed, accel):
+    # trapezoidal move from standstill to standstill
+    if dist <= 0.:
+        return 0.
+    accel_dist = speed * speed / accel
+    if dist < accel_dist:
+        return 2. * math.sqrt(dist / accel)
+    return dist / speed + speed / accel
+
+class SimToolhead:
+    def __init__(self, printer, max_velocity=300., max_accel=3000.,
+                 max_z_velocity=15., max_z_accel=350.):
+        self.printer = printer
+        self.reactor = printer.reactor
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        self.max_z_velocity = max_z_velocity
+        self.max_z_accel = max_z_accel
+        self.commanded_pos = [150., 150., 10., 0.]
+        self.print_time = 0.
+        self.move_count = 0
+        self.move_dist = 0.
+        self.extruder = SimHeater('extruder', 240.)
+    def _advance(self, delay):
+        self.print_time += delay
+        self.reactor.advance(delay)
+    def get_position(self):
+        return list(self.commanded_pos)
+    def set_position(self, newpos, homing_axes=()):
+        self.commanded_pos[:len(newpos)] = list(newpos)
+    def get_last_move_time(self):
+        return self.print_time
+    def get_max_velocity(self):
+        return self.max_velocity, self.max_accel
+    def get_extruder(self):
+        return self.extruder
+    def get_kinematics(self):
+        return self
+    def dwell(self, delay):
+        self._advance(delay)
+    def wait_moves(self):
+        pass
+    def flush_step_generation(self):
+        pass
+    def move_duration(self, start, end, speed):
+        axes_d = [end[i] - start[i] for i in range(3)]
+        dist = math.sqrt(sum([d * d for d in axes_d]))
+        if dist <= 0.:
+            return 0.
+        speed = min(speed, self.max_velocity)
+        accel = self.max_accel
+        if axes_d[2]:
+            z_ratio = dist / abs(axes_d[2])
+            speed = min(speed, self.max_z_velocity * z_ratio)
+            accel = min(accel, self.max_z_accel * z_ratio)
+        return move_time(dist, speed, accel)
+    def manual_move(self, coord, speed):
+        curpos = list(self.commanded_pos)
+        for i in range(len(coord)):
+            if coord[i] is not None:
+                curpos[i] = coord[i]
+        start = self.commanded_pos
+        self.move_count += 1
+        self.move_dist += math.sqrt(sum([(curpos[i] - start[i]) ** 2
+                                         for i in range(3)]))
+        self._advance(self.move_duration(start, curpos, speed))
+        self.commanded_pos = curpos
+        self.printer.world.check_position(curpos)
+
+class SimHoming:
+    def __init__(self, printer):
+        self.printer = printer
+        self.probe_count = 0
+    def probing_move(self, mcu_endstop, pos, speed):
+        toolhead = self.printer.lookup_object('toolhead')
+        world = self.printer.world
+        start = toolhead.get_position()
+        endstop = mcu_endstop
+        while not isinstance(endstop, SimEndstop):
+            endstop = endstop.mcu_endstop
+        trigger_z = world.trigger_z(endstop, start[0], start[1], speed)
+        self.probe_count += 1
+        if trigger_z is not None and trigger_z >= start[2]:
+            raise CommandError("Probe triggered prior to movement")
+        if trigger_z is None or trigger_z < pos[2]:
+            toolhead.manual_move([None, None, pos[2]], speed)
+            raise CommandError("No trigger on %s after full movement"
+                               % (endstop.name,))
+        toolhead.manual_move([None, None, trigger_z], speed)
+        return toolhead.get_position()
+
+######################################################################
+# Endstops and probe
+######################################################################
+
+class SimEndstop(MCU_endstop):
+    def __init__(self, printer, name):
+        self.printer = printer
+        self.name = name
+        self.sim_endstop = self
+    def get_mcu(self):
+        return None
+    def add_stepper(self, stepper):
+        pass
+    def get_steppers(self):
+        return []
+    def home_start(self, *args, **kwargs):
+        pass
+    def home_wait(self, *args, **kwargs):
+        pass
+    def query_endstop(self, print_time):
+        # the probe is a normally closed switch: open means not attached
+        if self.name == 'probe':
+            return not self.printer.world.probe_attached
+        return False
+
+class ProbeEndstopWrapper:
+    # newer Klipper: the probe's endstop nests the real mcu endstop
+    def __init__(self, mcu_endstop):
+        self.mcu_endstop = mcu_endstop
+        self.sim_endstop = mcu_endstop
+        self.query_endstop = mcu_endstop.query_endstop
+
+class SimProbeSession:
+    def __init__(self, probe):
+        self.probe = probe
+    def start_probe_session(self, gcmd):
+        self.probe.sessions += 1
+        return self
+    def end_probe_session(self):
+        self.probe.sessions -= 1
+
+class SimProbe:
+    def __init__(self, printer, api, offsets, params):
+        self.printer = printer
+        self.offsets = offsets
+        self.params = params
+        self.sessions = 0
+        endstop = SimEndstop(printer, 'probe')
+        if api == 'legacy':
+            # Klipper before 2024-06: flat attributes and multi_probe_*
+            self.mcu_probe = endstop
+            self.sample_count = params['samples']
+            self.samples_tolerance = params['samples_tolerance']
+            self.samples_retries = params['samples_tolerance_retries']
+            self.lift_speed = params['lift_speed']
+            self.samples_result = params['samples_result']
+            self.z_offset = offsets[2]
+            self.multi_probe_begin = self._begin
+            self.multi_probe_end = self._end
+        else:
+            self.mcu_probe = endstop
+            if api == 'wrapped':
+                self.mcu_probe = ProbeEndstopWrapper(endstop)
+            self.probe_session = SimProbeSession(self)
+    def _begin(self):
+        self.sessions += 1
+    def _end(self):
+        self.sessions -= 1
+    def get_offsets(self):
+        return self.offsets
+    def get_probe_params(self, gcmd=None):
+        return dict(self.params)
+    def get_status(self, eventtime):
+        return {'last_query': False}
+
+class SimHeater:
+    def __init__(self, name, temperature):
+        self.name = name
+        self.temperature = self.target = temperature
+    def get_name(self):
+        return self.name
+    def get_status(self, eventtime):
+        return {'temperature': self.temperature, 'target': self.target}
+
+class SimPrintStats:
+    # set state to 'printing' to simulate a print
+    def __init__(self):
+        self.state = 'standby'
+    def get_status(self, eventtime):
+        return {'state': self.state}
+
+ProbeResult = collections.namedtuple('probe_result', [
+    'bed_x', 'bed_y', 'bed_z', 'test_x', 'test_y', 'test_z'])
+
+class SimProbePointsHelper:
+    def __init__(self, finalize_callback):
+        self.finalize_callback = finalize_callback
+
+class SimBedMesh:
+    # BED_MESH_CALIBRATE probing a grid including the zero reference
+    def __init__(self, printer, api, zero_ref_pos, points=3):
+        self.printer = printer
+        self.api = api
+        self.points = points
+        self.probed = None
+        self.zero_ref_pos = zero_ref_pos
+        self.probe_helper = SimProbePointsHelper(self._finalize)
+        if api == 'legacy':
+            # Klipper before 2024-06: no probe manager
+            self.bmc = SimObject('bmc', zero_ref_pos=zero_ref_pos,
+                                 probe_helper=self.probe_helper)
+        else:
+            self.bmc = SimObject('bmc', probe_mgr=SimObject(
+                'probe_mgr', zero_ref_pos=zero_ref_pos,
+                probe_helper=self.probe_helper))
+        printer.lookup_object('gcode').register_command(
+            'BED_MESH_CALIBRATE', self.cmd_BED_MESH_CALIBRATE)
+    def _finalize(self, offsets, results):
+        self.probed = results
+    def cmd_BED_MESH_CALIBRATE(self, gcmd):
+        toolhead = self.printer.lookup_object('toolhead')
+        homing = self.printer.lookup_object('homing')
+        probe = self.printer.lookup_object('probe')
+        offsets = probe.get_offsets()
+        endstop = probe.mcu_probe
+        sites = [self.zero_ref_pos]
+        for i in range(self.points):
+            for j in range(self.points):
+                sites.append([50. + 100. * i, 50. + 100. * j])
+        results = []
+        for site in sites:
+            pos = [site[0] - offsets[0], site[1] - offsets[1]]
+            toolhead.manual_move([None, None, offsets[2] + 5.], 10.)
+            toolhead.manual_move(pos + [None], 300.)
+            epos = homing.probing_move(endstop, pos + [-5.], 5.)
+            if self.api == 'legacy':
+                results.append(epos[:3])
+            else:
+                results.append(ProbeResult(site[0], site[1],
+                                           epos[2] - offsets[2], epos[0],
+                                           epos[1], epos[2]))
+        toolhead.manual_move([None, None, offsets[2] + 5.], 10.)
+        # the probe points helper calls back with the (new) offsets first
+        self.probe_helper.finalize_callback(offsets, results)
+
+class SimObject:
+    def __init__(self, name, **attrs):
+        self.name = name
+        for key, value in attrs.items():
+            setattr(self, key, value)
+    def get_name(self):
+        return self.name
+
+class SimQueryEndstops:
+    def __init__(self):
+        self.endstops = []
+
+class SimStepper:
+    def is_active_axis(self, axis):
+        return axis == 'z'
+
+class SimRail:
+    def __init__(self, position_endstop=0.5, homing_speed=8.,
+                 second_homing_speed=3., homing_retract_dist=3.,
+                 position_min=-5.):
+        self.position_endstop = position_endstop
+        self.homing_speed = homing_speed
+        self.second_homing_speed = second_homing_speed
+        self.homing_retract_dist = homing_retract_dist
+        self.position_min = position_min
+    def get_steppers(self):
+        return [SimStepper()]
+
+######################################################################
+# Simulated machine
+######################################################################
+
+class SimWorld:
+    # The physical model: trigger heights at each site and sensor noise.
+    def __init__(self, nozzle_site, switch_site, bed_site, probe_offsets,
+                 nozzle_z=0.5, switch_z=7.2, bed_z=6.9, noise=0.002,
+                 outlier_rate=0., outlier=0.05, seed=1, dock_site=None,
+                 reactor=None, soak=None, speed_noise=0.):
+        self.nozzle_site = nozzle_site
+        self.dock_site = dock_site
+        self.switch_site = switch_site
+        self.bed_site = bed_site
+        self.probe_offsets = probe_offsets
+        self.nozzle_z = nozzle_z
+        self.switch_z = switch_z
+        self.bed_z = bed_z
+        self.noise = noise
+        self.outlier_rate = outlier_rate
+        self.outlier = outlier
+        self.rand = random.Random(seed)
+        self.probe_attached = False
+        # z endstop triggers at the nozzle with the probe hanging below it
+        self.attached_nozzle_taps = 0
+        self.drift = 0.
+        # heat soak: (amplitude, time constant) of an exponential decay of
+        # the bed height over the reactor time
+        self.reactor = reactor
+        self.soak = soak
+        self.speed_noise = speed_noise
+    def _get_drift(self):
+        drift = self.drift
+        if self.soak is not None:
+            amplitude, time_constant = self.soak
+            drift += amplitude * math.exp(-self.reactor.monotonic()
+                                          / time_constant)
+        return drift
+    def _near(self, x, y, site, dist=2.):
+        return abs(x - site[0]) <= dist and abs(y - site[1]) <= dist
+    def _noise(self, speed):
+        # faster probing is less repeatable
+        value = self.rand.gauss(0., self.noise
+                                * (1. + self.speed_noise * speed))
+        if self.outlier_rate and self.rand.random() < self.outlier_rate:
+            value += self.outlier
+        return value
+    def trigger_z(self, endstop, x, y, speed=0.):
+        if endstop.name == 'z':
+            if self._near(x, y, self.nozzle_site):
+                if self.probe_attached:
+                    self.attached_nozzle_taps += 1
+                return self.nozzle_z + self._noise(speed)
+            if self.probe_attached and self._near(x, y, self.switch_site):
+                return self.switch_z + self._noise(speed)
+            return None
+        if endstop.name == 'probe':
+            if not self.probe_attached:
+                return None
+            px = x + self.probe_offsets[0]
+            py = y + self.probe_offsets[1]
+            if self._near(px, py, self.bed_site, 1000.):
+                return self.bed_z + self._get_drift() + self._noise(speed)
+        return None
+    def check_position(self, pos):
+        pass
+
+class SimPrinter:
+    config_error = ConfigError
+    command_error = CommandError
+    def __init__(self):
+        self.reactor = SimReactor()
+        self.objects = {}
+        self.sections = {}
+        self.handlers = {}
+        self.world = None
+        self.shutdown = False
+    def get_reactor(self):
+        return self.reactor
+    def is_shutdown(self):
+        return self.shutdown
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def lookup_object(self, name, default=SENTINEL):
+        if name in self.objects:
+            return self.objects[name]
+        if default is SENTINEL:
+            raise self.config_error("Unknown config object '%s'" % (name,))
+        return default
+    def lookup_objects(self, module=None):
+        if module is None:
+            return list(self.objects.items())
+        return [(n, o) for n, o in self.objects.items()
+                if n == module or n.startswith(module + ' ')]
+    def load_object(self, config, section, default=SENTINEL):
+        return self.lookup_object(section, default)
+    def register_event_handler(self, event, callback):
+        self.handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.handlers.get(event, [])]
+
+######################################################################
+# Setup helpers
+######################################################################
+
+DEFAULT_CONFIG = {
+    'nozzle_xy_position': '92.5,300.0',
+    'switch_xy_position': '92.5,292.0',
+    'bed_xy_position': '150.0,150.0',
+    'switch_offset': '0.5',
+    'samples': '5',
+    'samples_tolerance': '0.006',
+    'samples_tolerance_retries': '3',
+}
+
+DEFAULT_PROBE_PARAMS = {
+    'samples': 3, 'samples_tolerance': 0.006,
+    'samples_tolerance_retries': 3, 'lift_speed': 10.,
+    'samples_result': 'median', 'probe_speed': 5.,
+}
+
+class Simulation:
+    def __init__(self, config=None, api='current', noise=0.002,
+                 outlier_rate=0., seed=1, probe_offsets=(0., 25., 6.4),
+                 toolhead_args=None, extra_sections=None, dock_site=None,
+                 soak=None, temperature_sensors=None, speed_noise=0.):
+        install_modules()
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(
+            __file__)))
+        if repo_dir not in sys.path:
+            sys.path.insert(0, repo_dir)
+        import z_calibration
+        self.module = z_calibration
+        options = dict(DEFAULT_CONFIG)
+        options.update(config or {})
+        self.printer = printer = SimPrinter()
+        gcode = SimGCode(printer)
+        printer.add_object('gcode', gcode)
+        printer.add_object('webhooks', SimWebhooks())
+        printer.add_object('configfile', SimConfigFile())
+        printer.add_object('gcode_macro', SimGCodeMacro(printer))
+        printer.add_object('gcode_move', SimGCodeMove(printer))
+        printer.add_object('toolhead', SimToolhead(printer,
+                                                   **(toolhead_args or {})))
+        printer.add_object('homing', SimHoming(printer))
+        printer.add_object('heater_bed', SimHeater('heater_bed', 100.))
+        printer.add_object('print_stats', SimPrintStats())
+        for name, temperature in (temperature_sensors or {}).items():
+            printer.add_object(name, SimHeater(name, temperature))
+        query_endstops = SimQueryEndstops()
+        self.z_endstop = SimEndstop(printer, 'z')
+        query_endstops.endstops.append((self.z_endstop, 'z'))
+        printer.add_object('query_endstops', query_endstops)
+        self.probe = SimProbe(printer, api, list(probe_offsets),
+                              dict(DEFAULT_PROBE_PARAMS))
+        printer.add_object('probe', self.probe)
+        parse = lambda s: [float(v) for v in s.split(',')]
+        printer.add_object('bed_mesh', SimBedMesh(
+            printer, api, parse(options['bed_xy_position'])))
+        printer.world = self.world = SimWorld(
+            parse(options['nozzle_xy_position']),
+            parse(options['switch_xy_position']),
+            parse(options['bed_xy_position']), probe_offsets,
+            noise=noise, outlier_rate=outlier_rate, seed=seed,
+            dock_site=dock_site, reactor=printer.reactor, soak=soak,
+            speed_noise=speed_noise)
+        if 'before_switch_gcode' not in options:
+            options['before_switch_gcode'] = 'SIM_ATTACH_PROBE'
+        if 'end_gcode' not in options:
+            options['end_gcode'] = 'SIM_DETACH_PROBE'
+        for name, section in (extra_sections or {}).items():
+            printer.sections[name] = SimConfig(printer, name, section)
+        self.config = SimConfig(printer, 'z_calibration', options)
+        printer.sections['z_calibration'] = self.config
+        self.helper = z_calibration.load_config(self.config)
+        printer.add_object('z_calibration', self.helper)
+        for name, section in sorted(printer.sections.items()):
+            if (name.startswith('z_calibration ')
+                and hasattr(z_calibration, 'load_config_prefix')):
+                printer.add_object(name,
+                                   z_calibration.load_config_prefix(section))
+        self.rail = SimRail()
+        self.start_time = 0.
+        gcode.register_command('G28', self.cmd_G28)
+        printer.send_event("klippy:connect")
+    def cmd_G28(self, gcmd):
+        self.home()
+    def home(self):
+        toolhead = self.printer.lookup_object('toolhead')
+        world = self.world
+        toolhead.manual_move(list(world.nozzle_site) + [None], 300.)
+        toolhead.commanded_pos[2] = self.rail.position_endstop
+        self.printer.send_event("homing:home_rails_end",
+                                SimObject('homing_state'), [self.rail])
+        toolhead.manual_move([None, None, 10.], 10.)
+    def run(self, script):
+        self.printer.lookup_object('gcode').run_script(script)
+    def stats(self):
+        toolhead = self.printer.lookup_object('toolhead')
+        homing = self.printer.lookup_object('homing')
+        # the reactor time includes any pause of the commands
+        return {'time': self.printer.reactor.monotonic() - self.start_time,
+                'moves': toolhead.move_count,
+                'probes': homing.probe_count,
+                'distance': toolhead.move_dist}
+    def reset_stats(self):
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.print_time = 0.
+        self.start_time = self.printer.reactor.monotonic()
+        toolhead.move_count = 0
+        toolhead.move_dist = 0.
+        self.printer.lookup_object('homing').probe_count = 0
+
+class SimWebhooks:
+    def __init__(self):
+        self.endpoints = {}
+    def register_endpoint(self, path, callback):
+        self.endpoints[path] = callback
+    def register_mux_endpoint(self, path, key, value, callback):
+        self.endpoints[path] = callback
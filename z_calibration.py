@@ -3,19 +3,47 @@
 # Copyright (C) 2021-2025  Titus Meyer <info@protoloft.org>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, json, bisect, collections, os, queue, threading, time
 from mcu import MCU_endstop
 
+MAD_SCALE = 1.4826
+MAD_THRESHOLD = 3.
+TRAVEL_EPSILON = .001
+ACCURACY_SITES = ['nozzle', 'switch', 'bed']
+MIN_SIGMA_SAMPLES = 3
+RETRACT_SPREAD_FACTOR = 2.
+SITE_TOLERANCE = .1
+DRIFT_MIN_STEP = .001
+T_VALUES_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306,
+               2.262, 2.228]
+
 class ZCalibrationHelper:
     def __init__(self, config):
         self.state = None
         self.z_endstop = None
         self.z_homing = None
+        self.adapter = None
         self.last_state = False
         self.last_z_offset = 0.
         self.position_z_endstop = None
+        self.homing_generation = 0
+        self.cache = None
+        self.tools = {}
+        self.tool_offsets = {}
+        self.site_results = {}
+        self.mesh_result = None
+        self.homing_trigger = None
+        self.probe_attached = None
+        self.run_stats = None
+        self.last_run = None
+        self.status = {}
+        self.clients = []
+        self.drift = None
+        self.drift_sensor = None
+        self.drift_timer = None
         self.config = config
         self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
         self.switch_offset = config.getfloat('switch_offset', None, above=0.)
         # TODO: remove: max_deviation is deprecated
         self.max_deviation = config.getfloat('max_deviation', None, above=0.)
@@ -23,6 +51,12 @@ class ZCalibrationHelper:
         self.offset_margins = self._get_offset_margins('offset_margins',
                                                      '-1.0,1.0')
         self.speed = config.getfloat('speed', 50.0, above=0.)
+        self.combine_lift = config.getboolean('combine_lift_travel', False)
+        self.combine_lift_min_z = None
+        if self.combine_lift:
+            # the height clearing the switch housing and the bed edges
+            self.combine_lift_min_z = config.getfloat('combine_lift_min_z',
+                                                      above=0.)
         # TODO: remove: clearance is deprecated
         self.clearance = config.getfloat('clearance', None, above=0.)
         config.deprecate('clearance')
@@ -31,7 +65,11 @@ class ZCalibrationHelper:
         self.tolerance = config.getfloat('samples_tolerance', None, above=0.)
         self.retries = config.getint('samples_tolerance_retries',
                                      None, minval=0)
-        atypes = {'none': None, 'median': 'median', 'average': 'average'}
+        self.samples_min = config.getint('samples_min', 2, minval=2)
+        self.ci_target = config.getfloat('samples_ci_target', None, above=0.)
+        self.max_taps = config.getint('samples_max_taps', None, minval=1)
+        atypes = {'none': None, 'median': 'median', 'average': 'average',
+                  'mad': 'mad'}
         self.samples_result = config.getchoice('samples_result', atypes,
                                                'none')
         self.lift_speed = config.getfloat('lift_speed', None, above=0.)
@@ -40,37 +78,125 @@ class ZCalibrationHelper:
                                             None, above=0.)
         self.retract_dist = config.getfloat('probing_retract_dist',
                                             None, above=0.)
+        self.retract_min_dist = config.getfloat('probing_retract_min_dist',
+                                                None, above=0.)
         self.position_min = config.getfloat('position_min', None)
         self.first_fast = config.getboolean('probing_first_fast', False)
+        self.approach_margin = config.getfloat('approach_margin', None,
+                                               above=0.)
+        self.mesh_max_age = config.getfloat('bed_mesh_max_age', None,
+                                            above=0.)
+        self.homing_max_age = config.getfloat('homing_trigger_max_age', None,
+                                              above=0.)
+        self.cache_max_age = config.getfloat('cache_max_age', 600., above=0.)
+        self.site_max_age = config.getfloat('site_max_age', 600., above=0.)
+        self.verify_tolerance = config.getfloat('verify_tolerance', 0.01,
+                                                above=0.)
+        self.soak_interval = config.getfloat('soak_interval', 30., above=0.)
+        self.soak_threshold = config.getfloat('soak_threshold', 0.001,
+                                              above=0.)
+        self.soak_timeout = config.getfloat('soak_timeout', 1800., above=0.)
+        self.soak_window = config.getint('soak_window', 4, minval=3)
+        self.drift_sensor_name = config.get('drift_sensor', None)
+        self.drift_interval = config.getfloat('drift_interval', 10., above=0.)
+        self.drift_max_correction = config.getfloat('drift_max_correction',
+                                                    0.05, above=0.)
+        self.drift_max_rate = config.getfloat('drift_max_rate', 0.01,
+                                              above=0.)
+        self.drift_min_samples = config.getint('drift_min_samples', 5,
+                                               minval=3)
+        self.drift_min_span = config.getfloat('drift_min_span', 2., above=0.)
+        self.console_verbosity = config.getchoice(
+            'console_verbosity', {'samples': 'samples', 'results': 'results'},
+            'samples')
+        self.history = collections.deque(
+            maxlen=config.getint('history_length', 100, minval=2))
+        self.history_writer = None
+        history_file = config.get('history_file', None)
+        if history_file is not None:
+            self.history_writer = HistoryWriter(
+                os.path.expanduser(history_file),
+                config.getint('history_max_size', 1048576, minval=1024))
+            self.history_writer.load(self.history)
+            self.printer.register_event_handler("klippy:disconnect",
+                                                self.history_writer.stop)
+        self.cache_temp_tolerance = config.getfloat('cache_temp_tolerance',
+                                                    2., minval=0.)
         self.nozzle_site = self._get_xy("nozzle_xy_position", True)
         self.switch_site = self._get_xy("switch_xy_position", True)
         self.switch_xy_offsets = self._get_xy("switch_xy_offsets", True)
         self.bed_site = self._get_xy("bed_xy_position", True)
         self.wiggle_offsets = self._get_xy("wiggle_xy_offsets", True)
+        self.wiggle_threshold = config.getfloat('wiggle_threshold', None,
+                                                minval=0.)
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.start_gcode = gcode_macro.load_template(config, 'start_gcode', '')
         self.switch_gcode = gcode_macro.load_template(config,
                                                       'before_switch_gcode',
                                                       '')
         self.end_gcode = gcode_macro.load_template(config, 'end_gcode', '')
+        self.nozzle_gcode = None
+        if config.get('before_nozzle_gcode', None) is not None:
+            self.nozzle_gcode = gcode_macro.load_template(
+                config, 'before_nozzle_gcode')
         self.query_endstops = self.printer.load_object(config,
                                                        'query_endstops')
         self.printer.register_event_handler("klippy:connect",
                                             self.handle_connect)
         self.printer.register_event_handler("homing:home_rails_end",
                                             self.handle_home_rails_end)
+        if self.drift_sensor_name is not None:
+            self.printer.register_event_handler("klippy:shutdown",
+                                                self.handle_shutdown)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("z_calibration/subscribe",
+                                   self._handle_subscribe)
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command('CALIBRATE_Z', self.cmd_CALIBRATE_Z,
                                     desc=self.cmd_CALIBRATE_Z_help)
         self.gcode.register_command('PROBE_Z_ACCURACY',
                                     self.cmd_PROBE_Z_ACCURACY,
                                     desc=self.cmd_PROBE_Z_ACCURACY_help)
+        self.gcode.register_command('CALIBRATE_Z_TOOLS',
+                                    self.cmd_CALIBRATE_Z_TOOLS,
+                                    desc=self.cmd_CALIBRATE_Z_TOOLS_help)
+        self.gcode.register_command('Z_CALIBRATION_HISTORY',
+                                    self.cmd_Z_CALIBRATION_HISTORY,
+                                    desc=self.cmd_Z_CALIBRATION_HISTORY_help)
+        self.gcode.register_command('TUNE_PROBING_SPEED',
+                                    self.cmd_TUNE_PROBING_SPEED,
+                                    desc=self.cmd_TUNE_PROBING_SPEED_help)
         self.gcode.register_command('CALCULATE_SWITCH_OFFSET',
                                     self.cmd_CALCULATE_SWITCH_OFFSET,
                                     desc=self.cmd_CALCULATE_SWITCH_OFFSET_help)
+        self._update_status()
     def get_status(self, eventtime):
-        return {'last_query': self.last_state,
-                'last_z_offset': self.last_z_offset}
+        return self.status
+    def _update_status(self):
+        # the status is rebuilt on changes only, polling it is cheap
+        self.status = {'last_query': self.last_state,
+                       'last_z_offset': self.last_z_offset,
+                       'tool_offsets': dict(self.tool_offsets),
+                       'probe_attached': self.probe_attached,
+                       'drift_correction': (self.drift or {}).get(
+                           'correction'),
+                       'last_run': self.last_run}
+    def _handle_subscribe(self, web_request):
+        # stream the sample and run events to the client
+        cconn = web_request.get_client_connection()
+        template = web_request.get_dict('response_template', {})
+        self.clients.append((cconn, template))
+        web_request.send({'events': ['sample', 'run', 'accuracy']})
+    def _send_event(self, event, params):
+        for cconn, template in list(self.clients):
+            if cconn.is_closed():
+                self.clients.remove((cconn, template))
+                continue
+            msg = dict(template)
+            msg['params'] = dict(params, event=event)
+            cconn.send(msg)
+    def register_tool(self, tool):
+        self.tools[tool.name] = tool
     def handle_connect(self):
         # get endstop
         for endstop, name in self.query_endstops.endstops:
@@ -84,44 +210,103 @@ class ZCalibrationHelper:
         if self.z_endstop is None:
             raise self.printer.config_error("No z-endstop found for %s"
                                             % (self.config.get_name()))
-        # get probing settings
-        probe = self.printer.lookup_object('probe', default=None)
-        if probe is None:
+        if self.printer.lookup_object('probe', default=None) is None:
             raise self.printer.config_error("A probe is needed for %s"
                                             % (self.config.get_name()))
-        # TODO: remove: deprecated since 2024-06-10
-        if hasattr(probe, 'sample_count'):
-            if self.samples is None:
-                self.samples = probe.sample_count
-            if self.tolerance is None:
-                self.tolerance = probe.samples_tolerance
-            if self.retries is None:
-                self.retries = probe.samples_retries
-            if self.lift_speed is None:
-                self.lift_speed = probe.lift_speed
-            if self.samples_result is None:
-                self.samples_result = probe.samples_result
-            if self.safe_z_height is None:
-                self.safe_z_height = probe.z_offset * 2
-        else:
-            probe_params = probe.get_probe_params()
-            if self.samples is None:
-                self.samples = probe_params['samples']
-            if self.tolerance is None:
-                self.tolerance = probe_params['samples_tolerance']
-            if self.retries is None:
-                self.retries = probe_params['samples_tolerance_retries']
-            if self.lift_speed is None:
-                self.lift_speed = probe_params['lift_speed']
-            if self.samples_result is None:
-                self.samples_result = probe_params['samples_result']
-            if self.safe_z_height is None:
-                self.safe_z_height = probe.get_offsets()[2] * 2
+        # resolve the Klipper API once
+        self.adapter = adapter = KlipperAdapter(self.printer)
+        # get probing settings
+        probe_params = adapter.get_probe_params()
+        if self.samples is None:
+            self.samples = probe_params['samples']
+        if self.tolerance is None:
+            self.tolerance = probe_params['samples_tolerance']
+        if self.retries is None:
+            self.retries = probe_params['samples_tolerance_retries']
+        if self.lift_speed is None:
+            self.lift_speed = probe_params['lift_speed']
+        if self.samples_result is None:
+            self.samples_result = probe_params['samples_result']
+        if self.safe_z_height is None:
+            self.safe_z_height = probe_params['z_offset'] * 2
         # TODO: remove: clearance is deprecated
         if self.clearance is not None and self.clearance == 0:
             self.clearance = 20 # defaults to 20mm
         if self.safe_z_height < 3:
             self.safe_z_height = 20 # defaults to 20mm
+        if self.max_taps is None:
+            self.max_taps = self.samples * (self.retries + 1)
+        elif self.max_taps < self.samples:
+            raise self.printer.config_error("samples_max_taps must not be"
+                                            " lower than samples for %s"
+                                            % (self.config.get_name()))
+        if self.mesh_max_age is not None:
+            self._hook_bed_mesh()
+        if self.drift_sensor_name is not None:
+            self.drift_sensor = self.printer.lookup_object(
+                self.drift_sensor_name)
+            self.drift_timer = self.reactor.register_timer(
+                self._handle_drift_timer)
+    def handle_shutdown(self):
+        if self.drift_timer is not None:
+            self.reactor.update_timer(self.drift_timer, self.reactor.NEVER)
+    def _hook_bed_mesh(self):
+        # capture the probe results of BED_MESH_CALIBRATE by wrapping the
+        # finalize callback of its probe points helper
+        if self.adapter.bed_mesh is None:
+            raise self.printer.config_error("bed_mesh_max_age needs a"
+                                            " [bed_mesh] for %s"
+                                            % (self.config.get_name()))
+        probe_helper = self.adapter.mesh_probe_helper
+        if probe_helper is not None:
+            finalize = probe_helper.finalize_callback
+            def finalize_wrapper(*args):
+                self._capture_mesh_result(args[-1])
+                return finalize(*args)
+            probe_helper.finalize_callback = finalize_wrapper
+            return
+        logging.warning("%s: unable to capture the bed mesh probe results,"
+                        " bed_mesh_max_age is ignored"
+                        % (self.config.get_name()))
+        self.mesh_max_age = None
+    def _capture_mesh_result(self, results):
+        positions = []
+        for result in results:
+            # TODO: remove: list results are deprecated since 2025-02
+            if hasattr(result, 'test_z'):
+                positions.append((result.test_x, result.test_y,
+                                  result.test_z))
+            else:
+                positions.append(tuple(result[:3]))
+        self.mesh_result = {'time': self.reactor.monotonic(),
+                            'homing': self.homing_generation,
+                            'positions': positions}
+    def _get_homing_samples(self, nozzle_site):
+        # the last z homing as a nozzle sample, if it was fresh and at the
+        # nozzle site
+        trigger = self.homing_trigger
+        if self.homing_max_age is None or trigger is None:
+            return []
+        pos = trigger['position']
+        if (self.reactor.monotonic() - trigger['time'] > self.homing_max_age
+            or abs(pos[0] - nozzle_site[0]) >= SITE_TOLERANCE
+            or abs(pos[1] - nozzle_site[1]) >= SITE_TOLERANCE):
+            return []
+        return [list(pos)]
+    def _get_mesh_probe_zero(self, probe_site):
+        # the probed height at probe_site from a fresh bed mesh, if any
+        mesh_result = self.mesh_result
+        if self.mesh_max_age is None or mesh_result is None:
+            return None
+        if (mesh_result['homing'] != self.homing_generation
+            or (self.reactor.monotonic() - mesh_result['time']
+                > self.mesh_max_age)):
+            return None
+        for x_pos, y_pos, z_pos in mesh_result['positions']:
+            if (abs(x_pos - probe_site[0]) < SITE_TOLERANCE
+                and abs(y_pos - probe_site[1]) < SITE_TOLERANCE):
+                return z_pos
+        return None
     def handle_home_rails_end(self, homing_state, rails):
         # get z homing position
         for rail in rails:
@@ -137,24 +322,312 @@ class ZCalibrationHelper:
                 if self.position_min is None:
                     self.position_min = rail.position_min
                 self.position_z_endstop = rail.position_endstop
+                # every z homing invalidates earlier measurements
+                self.homing_generation += 1
+                # the z-endstop triggered at position_endstop
+                pos = self.adapter.toolhead.get_position()
+                self.homing_trigger = {'time': self.reactor.monotonic(),
+                                       'position': [pos[0], pos[1],
+                                                    rail.position_endstop]}
     def _build_config(self):
         pass
     cmd_CALIBRATE_Z_help = ("Automatically calibrates the nozzle offset"
                             " to the print surface")
     def cmd_CALIBRATE_Z(self, gcmd):
+        if gcmd.get_int("DRY_RUN", 0, minval=0, maxval=1):
+            self._dry_run(gcmd)
+            return
+        self.last_state = False
+        self._update_status()
+        if self.z_homing is None:
+            raise gcmd.error("%s: must home axes first" % (gcmd.get_command()))
+        nozzle_site = self._get_nozzle_site(gcmd)
+        switch_site = self._get_switch_site(gcmd, nozzle_site)
+        bed_site = self._get_bed_site(gcmd)
+        switch_offset = self._get_switch_offset(gcmd)
+        use_cache = gcmd.get_int("CACHE", 0, minval=0, maxval=1)
+        verify = gcmd.get_int("VERIFY", 0, minval=0, maxval=1)
+        soak = gcmd.get_int("SOAK", 0, minval=0, maxval=1)
+        sites = self._get_calibration_sites(gcmd)
+        if verify and self.cache is None:
+            gcmd.respond_info("%s: no previous offset to verify,"
+                              " calibrating..." % (gcmd.get_command()))
+            verify = 0
+        state = CalibrationState(self, gcmd)
+        try:
+            if use_cache and self._apply_cache(gcmd, state, switch_offset,
+                                               nozzle_site, switch_site,
+                                               bed_site):
+                return
+            self._log_params(gcmd, switch_offset, nozzle_site, switch_site,
+                             bed_site)
+            state.calibrate_z(switch_offset, nozzle_site, switch_site,
+                              bed_site, verify, soak, sites)
+            self.cache = self._get_fingerprint(switch_offset, nozzle_site,
+                                               switch_site, bed_site)
+            self.cache['offset'] = self.last_z_offset
+        finally:
+            self._finish_run(gcmd, state)
+    def _dry_run(self, gcmd):
+        # estimate the run from the plan without moving the toolhead
+        command = gcmd.get_command()
+        if self.z_homing is None:
+            raise gcmd.error("%s: must home axes first" % (command,))
+        nozzle_site = self._get_nozzle_site(gcmd)
+        switch_site = self._get_switch_site(gcmd, nozzle_site)
+        bed_site = self._get_bed_site(gcmd)
+        self._get_switch_offset(gcmd)
+        verify = (gcmd.get_int("VERIFY", 0, minval=0, maxval=1)
+                  and self.cache is not None)
+        names = self._get_calibration_sites(gcmd)
+        probe_offsets = self.adapter.probe.get_offsets()
+        probe_site = [bed_site[0] - probe_offsets[0],
+                      bed_site[1] - probe_offsets[1], bed_site[2]]
+        sites = [('nozzle', nozzle_site, True), ('switch', switch_site, False),
+                 ('bed', probe_site, False)]
+        sites = [site for site in sites if site[0] in names]
+        pos = self.adapter.toolhead.get_position()[:3]
+        plan = self._plan_sites(pos, [(site, split_xy)
+                                      for name, site, split_xy in sites])
+        lines = ["%s: dry run, excluding the gcode templates:" % (command,)]
+        total = [0., 0.]
+        for (name, site, split_xy), moves in zip(sites, plan):
+            if name == 'bed' and self._get_mesh_probe_zero(site) is not None:
+                lines.append("%s at %.3f,%.3f: bed mesh result reused"
+                             % (name, site[0], site[1]))
+                continue
+            taps = [self.samples, self.max_taps]
+            if name == 'nozzle':
+                seeded = len(self._get_homing_samples(site))
+                taps = [max(0, count - seeded) for count in taps]
+            if verify:
+                taps = [1, 1 + self.max_taps]
+            travel_time, pos = self._estimate_moves(pos, moves)
+            if taps[1]:
+                probe_times, pos = self._estimate_probing(pos, name, taps)
+            else:
+                probe_times = [0., 0.]
+            lines.append("%s at %.3f,%.3f: %d travel moves %.1fs, %d-%d"
+                         " taps %.1f-%.1fs"
+                         % (name, site[0], site[1], len(moves), travel_time,
+                            taps[0], taps[1], probe_times[0],
+                            probe_times[1]))
+            total[0] += travel_time + probe_times[0]
+            total[1] += travel_time + probe_times[1]
+        lines.append("estimated time %.1fs, worst case %.1fs with all %d"
+                     " retries" % (total[0], total[1], self.retries))
+        gcmd.respond_info("\n".join(lines))
+    def _estimate_moves(self, pos, moves):
+        # the duration of moves as list of (coord, speed) from pos
+        duration = 0.
+        for coord, speed in moves:
+            end = [pos[i] if coord[i] is None else coord[i] for i in range(3)]
+            duration += self._estimate_move_time(pos, end, speed)
+            pos = end
+        return duration, pos
+    def _estimate_move_time(self, start, end, speed):
+        # trapezoidal move with the velocity and acceleration limits of
+        # the toolhead, reduced for a z move like the kinematics do
+        toolhead = self.adapter.toolhead
+        max_velocity, max_accel = toolhead.get_max_velocity()
+        kin = toolhead.get_kinematics()
+        axes_d = [end[i] - start[i] for i in range(3)]
+        dist = sum([d * d for d in axes_d]) ** 0.5
+        if not dist:
+            return 0.
+        velocity = min(speed, max_velocity)
+        accel = max_accel
+        if axes_d[2]:
+            ratio = dist / abs(axes_d[2])
+            velocity = min(velocity, getattr(kin, 'max_z_velocity',
+                                             max_velocity) * ratio)
+            accel = min(accel, getattr(kin, 'max_z_accel', max_accel) * ratio)
+        if dist < velocity * velocity / accel:
+            return 2. * (dist / accel) ** 0.5
+        return dist / velocity + velocity / accel
+    def _estimate_probing(self, pos, name, taps):
+        # the probing duration for the typical and the worst case number
+        # of taps, an unknown site is assumed to trigger at
+        # position_endstop
+        result = self.site_results.get(name)
+        trigger_z = self.position_z_endstop
+        if result is not None:
+            trigger_z = result['z']
+        trigger_pos = [pos[0], pos[1], trigger_z]
+        retract_pos = [pos[0], pos[1], trigger_z + self.retract_dist]
+        moves = []
+        approach_z = self._get_approach_z(name)
+        if approach_z is not None:
+            moves.append(([None, None, approach_z], self.probing_speed))
+        elif self.first_fast:
+            moves.append(([None, None, trigger_z], self.probing_speed))
+            moves.append(([None, None, retract_pos[2]], self.lift_speed))
+        duration, pos = self._estimate_moves(pos, moves)
+        # the first tap descends from there, all others after a retract
+        descent = self._estimate_move_time(retract_pos, trigger_pos,
+                                           self.second_speed)
+        duration += self._estimate_move_time(pos, trigger_pos,
+                                             self.second_speed) - descent
+        tap = descent + self._estimate_move_time(trigger_pos, retract_pos,
+                                                 self.lift_speed)
+        if name == 'nozzle' and self.wiggle_offsets is not None:
+            wiggle_pos = [retract_pos[0] + self.wiggle_offsets[0],
+                          retract_pos[1] + self.wiggle_offsets[1],
+                          retract_pos[2]]
+            tap += 2. * self._estimate_move_time(retract_pos, wiggle_pos,
+                                                 self.speed)
+        return [duration + count * tap for count in taps], retract_pos
+    cmd_CALIBRATE_Z_TOOLS_help = ("Calibrates the nozzle offsets of all"
+                                  " tools with a single bed and switch"
+                                  " probing")
+    def cmd_CALIBRATE_Z_TOOLS(self, gcmd):
         self.last_state = False
+        self._update_status()
         if self.z_homing is None:
             raise gcmd.error("%s: must home axes first" % (gcmd.get_command()))
+        names = gcmd.get("TOOLS", "")
+        if names:
+            names = [name.strip() for name in names.split(',')]
+        else:
+            names = sorted(self.tools.keys())
+        if not names:
+            raise gcmd.error("%s: no tools configured! Add a"
+                             " [z_calibration <tool>] section for each"
+                             " tool." % (gcmd.get_command()))
         nozzle_site = self._get_nozzle_site(gcmd)
         switch_site = self._get_switch_site(gcmd, nozzle_site)
         bed_site = self._get_bed_site(gcmd)
         switch_offset = self._get_switch_offset(gcmd)
+        tools = []
+        for name in names:
+            tool = self.tools.get(name)
+            if tool is None:
+                raise gcmd.error("%s: unknown tool %s"
+                                 % (gcmd.get_command(), name))
+            tools.append((tool, tool.nozzle_site or nozzle_site,
+                          tool.switch_offset or switch_offset))
         self._log_params(gcmd, switch_offset, nozzle_site, switch_site,
                          bed_site)
         state = CalibrationState(self, gcmd)
-        state.calibrate_z(switch_offset, nozzle_site, switch_site, bed_site)
+        try:
+            state.calibrate_tools(tools, switch_site, bed_site)
+        finally:
+            self._finish_run(gcmd, state)
+    def _finish_run(self, gcmd, state):
+        self.run_stats = None
+        self.last_run = state.stats.finish(self.last_state)
+        self._update_status()
+        logging.info("%s: run statistics: %s"
+                     % (gcmd.get_command(),
+                        json.dumps(self.last_run, sort_keys=True)))
+        entry = self._get_run_entry(gcmd, state)
+        self._send_event('run', entry)
+        if state.sites:
+            self._add_history(entry)
+            # a cached offset is not measured at the current temperature
+            if self.last_state and gcmd.get_command() == 'CALIBRATE_Z':
+                self._fit_drift(gcmd, entry)
+    def _get_run_entry(self, gcmd, state):
+        nozzle_temp, bed_temp = self._get_temperatures(
+            self.reactor.monotonic())
+        offset = None
+        if self.last_state and gcmd.get_command() == 'CALIBRATE_Z':
+            offset = self.last_z_offset
+        sensor_temp = None
+        if self.drift_sensor is not None:
+            sensor_temp = self._get_drift_temp(self.reactor.monotonic())
+        return {'time': time.time(),
+                'command': gcmd.get_command(),
+                'success': self.last_state,
+                'offset': offset,
+                'tool_offsets': dict(self.tool_offsets),
+                'nozzle_temp': nozzle_temp,
+                'bed_temp': bed_temp,
+                'sensor_temp': sensor_temp,
+                'sites': state.sites,
+                'run': self.last_run}
+    def _add_history(self, entry):
+        if entry['offset'] is not None:
+            self.history.append(entry)
+        if self.history_writer is not None:
+            self.history_writer.add(entry)
+    def _get_drift_temp(self, eventtime):
+        return self.drift_sensor.get_status(eventtime)['temperature']
+    def _fit_drift(self, gcmd, entry):
+        # the offset over the drift sensor temperature from the history,
+        # the new offset is the reference for the corrections
+        if self.drift_sensor is None:
+            return
+        self.drift = None
+        points = [(e['sensor_temp'], e['offset']) for e in self.history
+                  if e.get('sensor_temp') is not None]
+        temps = [point[0] for point in points]
+        if (len(points) < self.drift_min_samples
+            or max(temps) - min(temps) < self.drift_min_span):
+            logging.info("%s: not enough history for a drift compensation"
+                         % (gcmd.get_command()))
+        else:
+            slope = self._calc_slope(temps, [point[1] for point in points])
+            self.drift = {'slope': slope, 'temp': entry['sensor_temp'],
+                          'correction': 0.}
+            gcmd.respond_info("%s: drift compensation of %.6f/degree from"
+                              " %.1f" % (gcmd.get_command(), slope,
+                                         entry['sensor_temp']))
+        self._update_status()
+        self.reactor.update_timer(self.drift_timer,
+                                  self.reactor.NEVER if self.drift is None
+                                  else self.reactor.NOW)
+    def _is_printing(self, eventtime):
+        print_stats = self.adapter.print_stats
+        return (print_stats is not None
+                and print_stats.get_status(eventtime)['state'] == 'printing')
+    def _handle_drift_timer(self, eventtime):
+        drift = self.drift
+        if drift is None:
+            return self.reactor.NEVER
+        if self.run_stats is not None or not self._is_printing(eventtime):
+            # only during a print, a calibration sets a new reference
+            return eventtime + self.drift_interval
+        target = drift['slope'] * (self._get_drift_temp(eventtime)
+                                   - drift['temp'])
+        target = max(-self.drift_max_correction,
+                     min(self.drift_max_correction, target))
+        # limit the rate of the corrections
+        max_step = self.drift_max_rate * self.drift_interval / 60.
+        step = max(-max_step, min(max_step, target - drift['correction']))
+        if abs(step) >= DRIFT_MIN_STEP:
+            # queued behind the running commands like a console command
+            try:
+                self.gcode.run_script("SET_GCODE_OFFSET Z_ADJUST=%.6f"
+                                      % (step,))
+            except self.printer.command_error:
+                logging.exception("z_calibration: drift correction failed")
+                return eventtime + self.drift_interval
+            # a calibration while waiting has a new reference
+            if self.drift is not None:
+                self.drift['correction'] += step
+            self._update_status()
+        return self.reactor.monotonic() + self.drift_interval
+    cmd_Z_CALIBRATION_HISTORY_help = ("Reports statistics of the last"
+                                      " calibrated offsets")
+    def cmd_Z_CALIBRATION_HISTORY(self, gcmd):
+        count = gcmd.get_int("COUNT", len(self.history), minval=2)
+        offsets = [entry['offset'] for entry in self.history][-count:]
+        if len(offsets) < 2:
+            raise gcmd.error("%s: not enough calibrations in the history"
+                             % (gcmd.get_command()))
+        stats = RunningStats()
+        for offset in offsets:
+            stats.add(offset)
+        slope = self._calc_slope(range(len(offsets)), offsets)
+        gcmd.respond_info("%s: last %d offsets: mean=%.6f, sigma=%.6f,"
+                          " range=%.6f, trend=%.6f/run, last=%.6f"
+                          % (gcmd.get_command(), len(offsets), stats.mean,
+                             stats.get_sigma(),
+                             stats.max_value - stats.min_value, slope,
+                             offsets[-1]))
     cmd_PROBE_Z_ACCURACY_help = ("Probe Z-Endstop accuracy at"
-                                 " Nozzle-Endstop position")
+                                 " Nozzle-Endstop, switch or bed position")
     def cmd_PROBE_Z_ACCURACY(self, gcmd):
         if self.z_homing is None:
             raise gcmd.error("%s: must home axes first" % (gcmd.get_command()))
@@ -163,45 +636,118 @@ class ZCalibrationHelper:
         sample_count = gcmd.get_int("SAMPLES", self.samples, minval=1)
         sample_retract_dist = gcmd.get_float("SAMPLE_RETRACT_DIST",
                                              self.retract_dist, above=0.)
-        nozzle_site = self._get_nozzle_site(gcmd)
-        toolhead = self.printer.lookup_object('toolhead')
-        pos = toolhead.get_position()
-        self._move_safe_z(pos, lift_speed)
-        # move to z-endstop position
-        self._move(list(nozzle_site), self.speed)
-        pos = toolhead.get_position()
-        gcmd.respond_info("%s at X:%.3f Y:%.3f Z:%.3f"
-                          " (samples=%d retract=%.3f"
-                          " speed=%.1f lift_speed=%.1f)\n"
-                          % (gcmd.get_command(), pos[0], pos[1], pos[2],
-                             sample_count, sample_retract_dist, speed,
-                             lift_speed))
-        # Probe bed sample_count times
-        positions = []
-        while len(positions) < sample_count:
-            # Probe position
-            pos = self._probe(gcmd, self.z_endstop, self.position_min, speed)
-            positions.append(pos)
-            # Retract
-            liftpos = [None, None, pos[2] + sample_retract_dist]
-            self._move(liftpos, lift_speed)
-        # Calculate maximum, minimum and average values
-        max_value = max([p[2] for p in positions])
-        min_value = min([p[2] for p in positions])
-        range_value = max_value - min_value
-        avg_value = self._calc_mean(positions)[2]
-        median = self._calc_median(positions)[2]
-        # calculate the standard deviation
-        deviation_sum = 0
-        for i in range(len(positions)):
-            deviation_sum += pow(positions[i][2] - avg_value, 2.)
-        sigma = (deviation_sum / len(positions)) ** 0.5
+        target_sigma = gcmd.get_float("TARGET_SIGMA", 0., minval=0.)
+        batch = gcmd.get_int("INTERLEAVE", sample_count, minval=1)
+        report = gcmd.get_int("REPORT", 0, minval=0)
+        sites = self._get_accuracy_sites(gcmd, "nozzle")
+        state = CalibrationState(self, gcmd)
+        try:
+            results = state.probe_accuracy(sites, sample_count, [speed],
+                                           lift_speed, sample_retract_dist,
+                                           target_sigma, batch, report)
+        finally:
+            self.run_stats = None
+        self._send_event('accuracy', {
+            'command': gcmd.get_command(),
+            'sites': dict([(name, {'mean': stats.mean,
+                                   'median': stats.median.get(),
+                                   'sigma': stats.get_sigma(),
+                                   'min': stats.min_value,
+                                   'max': stats.max_value,
+                                   'samples': stats.count})
+                           for name, speed, stats in results])})
         # show result
-        gcmd.respond_info(
-            "%s: probe z accuracy results: maximum %.6f, minimum %.6f,"
-            " range %.6f, average %.6f, median %.6f, standard deviation %.6f"
-            % (gcmd.get_command(), max_value, min_value, range_value,
-               avg_value, median, sigma))        
+        for name, speed, stats in results:
+            prefix = gcmd.get_command()
+            if len(results) > 1:
+                prefix = "%s: %s" % (prefix, name)
+            gcmd.respond_info(
+                "%s: probe z accuracy results: maximum %.6f, minimum %.6f,"
+                " range %.6f, average %.6f, median %.6f,"
+                " standard deviation %.6f, samples %d"
+                % (prefix, stats.max_value, stats.min_value,
+                   stats.max_value - stats.min_value, stats.mean,
+                   stats.median.get(), stats.get_sigma(), stats.count))
+    def _get_site_names(self, gcmd, default):
+        names = [name.strip().lower()
+                 for name in gcmd.get("SITES", default).split(',')]
+        for name in names:
+            if name not in ACCURACY_SITES:
+                raise gcmd.error("%s: unknown site %s, use one of %s"
+                                 % (gcmd.get_command(), name,
+                                    ", ".join(ACCURACY_SITES)))
+        return names
+    def _get_accuracy_sites(self, gcmd, default):
+        names = self._get_site_names(gcmd, default)
+        nozzle_site = self._get_nozzle_site(gcmd)
+        sites = {'nozzle': nozzle_site}
+        if 'switch' in names:
+            sites['switch'] = self._get_switch_site(gcmd, nozzle_site)
+        if 'bed' in names:
+            sites['bed'] = self._get_bed_site(gcmd)
+        return [(name, sites[name]) for name in ACCURACY_SITES
+                if name in names]
+    cmd_TUNE_PROBING_SPEED_help = ("Finds the fastest probing_second_speed"
+                                   " within the samples_tolerance")
+    def cmd_TUNE_PROBING_SPEED(self, gcmd):
+        if self.z_homing is None:
+            raise gcmd.error("%s: must home axes first" % (gcmd.get_command()))
+        lift_speed = gcmd.get_float("LIFT_SPEED", self.lift_speed, above=0.)
+        sample_count = gcmd.get_int("SAMPLES", 10, minval=MIN_SIGMA_SAMPLES)
+        sample_retract_dist = gcmd.get_float("SAMPLE_RETRACT_DIST",
+                                             self.retract_dist, above=0.)
+        min_speed = gcmd.get_float("MIN_SPEED", self.second_speed, above=0.)
+        max_speed = gcmd.get_float("MAX_SPEED", 4. * min_speed,
+                                   minval=min_speed)
+        steps = gcmd.get_int("STEPS", 4, minval=1)
+        margin = gcmd.get_float("MARGIN", 3., minval=1.)
+        save = gcmd.get_int("SAVE", 0, minval=0, maxval=1)
+        sites = self._get_accuracy_sites(gcmd, "nozzle,switch,bed")
+        speeds = [min_speed]
+        if steps > 1:
+            speeds = [min_speed + (max_speed - min_speed) * i / (steps - 1.)
+                      for i in range(steps)]
+        state = CalibrationState(self, gcmd)
+        try:
+            results = state.probe_accuracy(sites, sample_count, speeds,
+                                           lift_speed, sample_retract_dist,
+                                           0., sample_count, 0)
+        finally:
+            self.run_stats = None
+        # the fastest speed, if all slower speeds are within the tolerance
+        # as well: the tolerance must cover margin times the sigma
+        limit = self.tolerance / margin
+        reference = dict([(name, stats.mean)
+                          for name, speed, stats in results
+                          if speed == speeds[0]])
+        best_speed = None
+        for speed in speeds:
+            site_stats = [(name, stats) for name, s, stats in results
+                          if s == speed]
+            sigma = max([stats.get_sigma() for name, stats in site_stats])
+            shift = max([abs(stats.mean - reference[name])
+                         for name, stats in site_stats])
+            passed = sigma <= limit
+            gcmd.respond_info("%s: speed=%.1f: maximum standard deviation"
+                              " %.6f, maximum shift %.6f --> %s"
+                              % (gcmd.get_command(), speed, sigma, shift,
+                                 "ok" if passed else "exceeds %.6f"
+                                 % (limit,)))
+            if not passed:
+                break
+            best_speed = speed
+        if best_speed is None:
+            raise gcmd.error("%s: no speed below %.6f, try a lower"
+                             " MIN_SPEED" % (gcmd.get_command(), limit))
+        gcmd.respond_info("%s: fastest probing_second_speed=%.1f"
+                          % (gcmd.get_command(), best_speed))
+        if save:
+            configfile = self.printer.lookup_object('configfile')
+            configfile.set(self.config.get_name(), 'probing_second_speed',
+                           "%.1f" % (best_speed,))
+            gcmd.respond_info("The SAVE_CONFIG command will update the"
+                              " printer config file and restart the"
+                              " printer.")
     cmd_CALCULATE_SWITCH_OFFSET_help = ("Calculates a switch_offset based on"
                                         " the current z position")
     def cmd_CALCULATE_SWITCH_OFFSET(self, gcmd):
@@ -222,6 +768,69 @@ class ZCalibrationHelper:
                               " Either the nozzle is still too far away or"
                               " something else is wrong..."
                               % (gcmd.get_command()))
+    def _get_temperatures(self, eventtime):
+        extruder = self.adapter.toolhead.get_extruder()
+        heater_bed = self.printer.lookup_object('heater_bed', default=None)
+        bed_temp = None
+        if heater_bed is not None:
+            bed_temp = heater_bed.get_status(eventtime)['temperature']
+        return extruder.get_status(eventtime)['temperature'], bed_temp
+    def _get_fingerprint(self, switch_offset, nozzle_site, switch_site,
+                         bed_site):
+        # everything a calibration result depends on
+        eventtime = self.reactor.monotonic()
+        extruder = self.adapter.toolhead.get_extruder()
+        nozzle_temp, bed_temp = self._get_temperatures(eventtime)
+        return {'time': eventtime,
+                'homing': self.homing_generation,
+                'tool': extruder.get_name(),
+                'nozzle_temp': nozzle_temp,
+                'bed_temp': bed_temp,
+                'sites': [list(nozzle_site[:2]), list(switch_site[:2]),
+                          list(bed_site[:2])],
+                'switch_offset': switch_offset}
+    def _check_cache(self, fingerprint):
+        # returns the reason why the cached result is not usable
+        cache = self.cache
+        if cache is None:
+            return "no cached result"
+        if cache['homing'] != fingerprint['homing']:
+            return "homed since last calibration"
+        if fingerprint['time'] - cache['time'] > self.cache_max_age:
+            return "cached result is too old"
+        if cache['tool'] != fingerprint['tool']:
+            return "different tool"
+        for key in ['nozzle_temp', 'bed_temp']:
+            if cache[key] is None or fingerprint[key] is None:
+                if cache[key] != fingerprint[key]:
+                    return "%s changed" % (key,)
+            elif (abs(cache[key] - fingerprint[key])
+                  > self.cache_temp_tolerance):
+                return "%s changed" % (key,)
+        if (cache['sites'] != fingerprint['sites']
+            or cache['switch_offset'] != fingerprint['switch_offset']):
+            return "different parameters"
+        return None
+    def _apply_cache(self, gcmd, state, switch_offset, nozzle_site,
+                     switch_site, bed_site):
+        fingerprint = self._get_fingerprint(switch_offset, nozzle_site,
+                                            switch_site, bed_site)
+        reason = self._check_cache(fingerprint)
+        if reason is not None:
+            gcmd.respond_info("%s: %s, calibrating..."
+                              % (gcmd.get_command(), reason))
+            return False
+        offset = self.cache['offset']
+        state._set_new_gcode_offset(offset)
+        if self.drift is not None:
+            # the cached offset is the reference of the drift compensation
+            self.drift['correction'] = 0.
+        self.last_state = True
+        self.last_z_offset = offset
+        gcmd.respond_info("%s: using cached offset=%.6f (age %.0fs)"
+                          % (gcmd.get_command(), offset,
+                             fingerprint['time'] - self.cache['time']))
+        return True
     def _get_nozzle_site(self, gcmd):
         nozzle_param = gcmd.get("NOZZLE_POSITION", "")
         safe_z_home = self.printer.lookup_object('safe_z_home', default=None)
@@ -257,7 +866,6 @@ class ZCalibrationHelper:
                          % (gcmd.get_command(), self.config.get_name()))
     def _get_bed_site(self, gcmd):
         bed_param = gcmd.get("BED_POSITION", "")
-        mesh = self.printer.lookup_object('bed_mesh', default=None)
         # from BED_POSITION parameter
         if bed_param:
             return self._parse_xy("BED_POSITION", bed_param, gcmd)
@@ -265,19 +873,9 @@ class ZCalibrationHelper:
         if self.bed_site is not None:
             return self.bed_site
         # from mesh's zero reference position
-        if mesh is not None:
-            if (hasattr(mesh.bmc, 'probe_mgr')
-                and mesh.bmc.probe_mgr.zero_ref_pos is not None):
-                return mesh.bmc.probe_mgr.zero_ref_pos
-            elif (hasattr(mesh.bmc, 'zero_ref_pos')
-                and mesh.bmc.zero_ref_pos is not None):
-                # TODO: remove - deprecated since 2024-06
-                return mesh.bmc.zero_ref_pos
-            elif (hasattr(mesh.bmc, 'relative_reference_index')
-                  and mesh.bmc.relative_reference_index is not None):
-                # TODO: remove: trying to read the deprecated rri
-                rri = mesh.bmc.relative_reference_index
-                return mesh.bmc.points[rri]
+        zero_ref_pos = self.adapter.get_mesh_zero_ref_pos()
+        if zero_ref_pos is not None:
+            return zero_ref_pos
         raise gcmd.error("%s: cannot find a bed position! Either configure the"
                          " bed_xy_position for %s, the mesh's"
                          " zero_reference_position, or use the NOZZLE_POSITION"
@@ -294,12 +892,14 @@ class ZCalibrationHelper:
                          " the switch_offset for %s, or use the SWITCH_OFFSET"
                          " parameter."
                          % (gcmd.get_command(), self.config.get_name()))
-    def _get_xy(self, name, optional=False):
-        if optional and self.config.get(name, None) is None:
+    def _get_xy(self, name, optional=False, config=None):
+        if config is None:
+            config = self.config
+        if optional and config.get(name, None) is None:
             return None
         else:
-            return self._parse_xy(name, self.config.get(name))
-    def _parse_xy(self, name, site, gcmd=None):
+            return self._parse_xy(name, config.get(name), config=config)
+    def _parse_xy(self, name, site, gcmd=None, config=None):
         try:
             x_pos, y_pos = site.split(',')
             return [float(x_pos), float(y_pos), None]
@@ -308,8 +908,10 @@ class ZCalibrationHelper:
                 raise gcmd.error("%s: unable to parse %s"
                                  % (gcmd.get_command(), name))
             else:
-                raise self.config.error("Unable to parse %s in %s"
-                                        % (name, self.config.get_name()))
+                if config is None:
+                    config = self.config
+                raise config.error("Unable to parse %s in %s"
+                                   % (name, config.get_name()))
     def _get_offset_margins(self, name, default):
         try:
             margins = self.config.get(name, default).split(',')
@@ -323,42 +925,195 @@ class ZCalibrationHelper:
         except:
             raise self.config.error("Unable to parse %s in %s"
                                     % (name, self.config.get_name()))
-    def _probe(self, gcmd, mcu_endstop, z_position, speed, wiggle=False):
-            toolhead = self.printer.lookup_object('toolhead')
-            pos = toolhead.get_position()
+    def _probe(self, gcmd, mcu_endstop, z_position, speed, wiggle=False,
+               previous=None):
+            pos = self.adapter.toolhead.get_position()
             pos[2] = z_position
             # probe
-            phoming = self.printer.lookup_object('homing')
-            curpos = phoming.probing_move(mcu_endstop, pos, speed)
+            curpos = self.adapter.probing_move(mcu_endstop, pos, speed)
+            if self.run_stats is not None:
+                self.run_stats.taps += 1
             # retract
-            self._move([None, None, curpos[2] + self.retract_dist],
+            self._move([None, None,
+                        curpos[2] + self._get_retract_dist(curpos, previous)],
                        self.lift_speed)
-            if wiggle and self.wiggle_offsets is not None:
+            if (wiggle and self.wiggle_offsets is not None
+                and self._needs_wiggle(curpos, previous)):
                 self._move([curpos[0] + self.wiggle_offsets[0],
                             curpos[1] + self.wiggle_offsets[1],
                             None],
                             self.speed)
                 self._move([curpos[0], curpos[1], None], self.speed)
-            self.gcode.respond_info("%s: probe at %.3f,%.3f is z=%.6f"
-                                    % (gcmd.get_command(), curpos[0],
-                                       curpos[1], curpos[2]))
+            if self.console_verbosity == 'samples':
+                self.gcode.respond_info("%s: probe at %.3f,%.3f is z=%.6f"
+                                        % (gcmd.get_command(), curpos[0],
+                                           curpos[1], curpos[2]))
             return curpos
+    def _store_site_result(self, name, z_position, spread, samples):
+        self.site_results[name] = {'z': z_position,
+                                   'spread': spread,
+                                   'samples': samples,
+                                   'time': self.reactor.monotonic(),
+                                   'homing': self.homing_generation}
+    def _check_site_result(self, result):
+        # the reason why a site result is not valid anymore, if any
+        if result is None:
+            return "there is no previous result"
+        if result['homing'] != self.homing_generation:
+            return "the result is from before the last z homing"
+        min_samples = self.samples
+        if self.ci_target is not None:
+            # adaptive sampling may stop early
+            min_samples = min(min_samples, self.samples_min)
+        if result['samples'] < min_samples:
+            # e.g. the single taps of a verify or a soak
+            return "the result has only %d samples" % (result['samples'],)
+        age = self.reactor.monotonic() - result['time']
+        if age > self.site_max_age:
+            return "the result is too old (%.0fs)" % (age,)
+        return None
+    def _get_site_result(self, gcmd, name):
+        # the last result of a site, if it may be reused in this run
+        result = self.site_results.get(name)
+        reason = self._check_site_result(result)
+        if reason is not None:
+            raise gcmd.error("%s: cannot reuse the %s site, %s"
+                             % (gcmd.get_command(), name, reason))
+        return result
+    def _get_calibration_sites(self, gcmd):
+        # the sites to probe, the others reuse their last result
+        names = self._get_site_names(gcmd, ",".join(ACCURACY_SITES))
+        # fail early if a reused site result is not valid
+        for name in ACCURACY_SITES:
+            if name not in names:
+                self._get_site_result(gcmd, name)
+        return names
+    def _get_approach_z(self, name):
+        # height to move to quickly before probing at a known site, the
+        # last result of any age is fine as the descent is guarded
+        result = self.site_results.get(name)
+        if self.approach_margin is None or result is None:
+            return None
+        return result['z'] + self.approach_margin
+    def _get_retract_dist(self, curpos, previous):
+        # adaptive retract: with known samples at this site, retract just
+        # enough to clear the observed spread, the first tap retracts fully
+        if self.retract_min_dist is None or not previous:
+            return self.retract_dist
+        z_positions = [pos[2] for pos in previous] + [curpos[2]]
+        spread = max(z_positions) - min(z_positions)
+        return min(self.retract_dist,
+                   self.retract_min_dist + RETRACT_SPREAD_FACTOR * spread)
+    def _needs_wiggle(self, curpos, previous):
+        # conditional wiggle: only if the last two samples disagree
+        if self.wiggle_threshold is None:
+            return True
+        if not previous:
+            return False
+        return abs(curpos[2] - previous[-1][2]) > self.wiggle_threshold
     def _move(self, coord, speed):
-        self.printer.lookup_object('toolhead').manual_move(coord, speed)
+        if self.run_stats is not None:
+            self.run_stats.moves += 1
+        self.adapter.manual_move(coord, speed)
     def _move_safe_z(self, pos, lift_speed):
+        safe_z = self._get_safe_z(pos)
+        if safe_z is not None:
+            self._move([None, None, safe_z], lift_speed)
+    def _get_safe_z(self, pos):
+        # an unknown z (None) is a position after probing: always lift
         # TODO: remove: clearance is deprecated
         if self.clearance is not None:
+            if pos[2] is None:
+                return self.clearance
             if pos[2] < self.clearance:
                 # no clearance, better to move up (relative)
-                self._move([None, None, pos[2] + self.clearance], lift_speed)
-        else:
-            if pos[2] < self.safe_z_height:
-                # no safe z position, better to move up (absolute)
-                self._move([None, None, self.safe_z_height], lift_speed)
+                return pos[2] + self.clearance
+        elif pos[2] is None or pos[2] < self.safe_z_height:
+            # no safe z position, better to move up (absolute)
+            return self.safe_z_height
+        return None
+    def _plan_travel(self, pos, site, split_xy=False, lift_speed=None):
+        # plan the moves from pos to site as a list of (coord, speed)
+        if lift_speed is None:
+            lift_speed = self.lift_speed
+        moves = []
+        same_x = abs(site[0] - pos[0]) < TRAVEL_EPSILON
+        same_y = abs(site[1] - pos[1]) < TRAVEL_EPSILON
+        # an X-then-Y split is only needed if both axes are moving
+        split_xy = split_xy and not same_x and not same_y
+        safe_z = self._get_safe_z(pos)
+        if same_x and same_y:
+            # already at the site, no need to lift
+            safe_z = None
+        if safe_z is not None:
+            min_z = self.combine_lift_min_z
+            if self.combine_lift and not split_xy and safe_z > min_z:
+                # lift straight up until clear of the switch and the bed
+                # edges, then lift the rest while traveling to the site
+                if pos[2] is None or pos[2] < min_z:
+                    moves.append(([None, None, min_z], lift_speed))
+                moves.append(([site[0], site[1], safe_z], self.speed))
+                same_x = same_y = True
+            else:
+                moves.append(([None, None, safe_z], lift_speed))
+        if split_xy:
+            moves.append(([site[0], pos[1], None], self.speed))
+        if not same_x or not same_y or site[2] is not None:
+            moves.append(([site[0], site[1], site[2]], self.speed))
+        return moves
+    def _plan_sites(self, pos, sites):
+        # plan the travel of a whole site sequence given as a list of
+        # (site, split_xy), each probed site leaves z unknown
+        plan = []
+        pos = list(pos[:3])
+        for site, split_xy in sites:
+            moves = self._plan_travel(pos, site, split_xy)
+            plan.append(moves)
+            pos = [site[0], site[1], None]
+        return plan
     def _calc_mean(self, positions):
         count = float(len(positions))
         return [sum([pos[i] for pos in positions]) / count
                 for i in range(3)]
+    def _is_confident(self, positions):
+        # adaptive sampling: stop as soon as the 95% confidence interval
+        # of the mean is narrower than the configured target
+        count = len(positions)
+        if self.ci_target is None or count < self.samples_min:
+            return False
+        mean = self._calc_mean(positions)[2]
+        variance = sum([pow(pos[2] - mean, 2.) for pos in positions])
+        deviation = (variance / (count - 1)) ** 0.5
+        ci = self._calc_t_value(count - 1) * deviation / count ** 0.5
+        return ci <= self.ci_target
+    def _calc_t_value(self, dof):
+        # two-sided 95% quantiles of Student's t distribution
+        if dof <= len(T_VALUES_95):
+            return T_VALUES_95[dof - 1]
+        return 1.96 + 2.5 / dof
+    def _reject_outliers(self, positions):
+        # MAD filter: drop samples too far away from the median
+        z_positions = [pos[2] for pos in positions]
+        if max(z_positions) - min(z_positions) <= self.tolerance:
+            return list(positions)
+        median = self._calc_median(positions)[2]
+        deviations = [abs(pos[2] - median) for pos in positions]
+        mad = self._calc_median([[0., 0., d] for d in deviations])[2]
+        limit = max(MAD_THRESHOLD * MAD_SCALE * mad, self.tolerance / 2.)
+        kept = [pos for pos, dev in zip(positions, deviations)
+                if dev <= limit]
+        z_positions = [pos[2] for pos in kept]
+        if kept and max(z_positions) - min(z_positions) <= self.tolerance:
+            return kept
+        # no clear outlier, so keep the largest group of samples within
+        # tolerance (the most recent one on a tie)
+        best = []
+        for first in reversed(positions):
+            group = [pos for pos in positions
+                     if 0. <= pos[2] - first[2] <= self.tolerance]
+            if len(group) > len(best):
+                best = group
+        return best
     def _calc_median(self, positions):
         z_sorted = sorted(positions, key=(lambda p: p[2]))
         middle = len(positions) // 2
@@ -367,6 +1122,17 @@ class ZCalibrationHelper:
             return z_sorted[middle]
         # even number of samples
         return self._calc_mean(z_sorted[middle-1:middle+1])
+    def _calc_slope(self, x_values, y_values):
+        # least squares slope of y over x
+        x_values = list(x_values)
+        count = float(len(x_values))
+        x_mean = sum(x_values) / count
+        y_mean = sum(y_values) / count
+        sxx = sum([pow(x - x_mean, 2.) for x in x_values])
+        if not sxx:
+            return 0.
+        return sum([(x - x_mean) * (y - y_mean)
+                    for x, y in zip(x_values, y_values)]) / sxx
     def _log_params(self, gcmd, switch_offset, nozzle_site, switch_site,
                     bed_site):
         logging.info("%s: switch_offset=%.3f, offset_margins=%.3f,%.3f,"
@@ -386,6 +1152,75 @@ class ZCalibrationHelper:
                         self.position_min, nozzle_site[0], nozzle_site[1],
                         switch_site[0], switch_site[1], bed_site[0],
                         bed_site[1]))
+class KlipperAdapter:
+    # resolves the objects and the API differences of the Klipper versions
+    # once at connect, so the probing needs no lookups or feature checks
+    def __init__(self, printer):
+        self.toolhead = printer.lookup_object('toolhead')
+        self.gcode_move = printer.lookup_object('gcode_move')
+        self.probe = probe = printer.lookup_object('probe')
+        self.bed_mesh = printer.lookup_object('bed_mesh', default=None)
+        self.print_stats = printer.lookup_object('print_stats', default=None)
+        self.manual_move = self.toolhead.manual_move
+        self.probing_move = printer.lookup_object('homing').probing_move
+        self.query_probe = probe.mcu_probe.query_endstop
+        # TODO: remove: deprecated since 2024-06-10
+        if hasattr(probe, 'multi_probe_begin'):
+            self.start_probe_session = probe.multi_probe_begin
+            self.end_probe_session = probe.multi_probe_end
+        else:
+            session = probe.probe_session
+            self.start_probe_session = (
+                lambda: session.start_probe_session(None))
+            self.end_probe_session = session.end_probe_session
+        # TODO: remove: deprecated since 2026-05-25
+        # Klipper's probe refactor nests the real MCU endstop inside
+        # ProbeEndstopWrapper, which itself no longer exposes
+        # get_steppers/home_start/etc. Unwrap when needed.
+        self.probe_endstop = probe.mcu_probe
+        if not hasattr(self.probe_endstop, 'get_steppers'):
+            self.probe_endstop = self.probe_endstop.mcu_endstop
+        # the bed mesh's probe points helper and zero reference
+        self.mesh_probe_helper = None
+        self.get_mesh_zero_ref_pos = lambda: None
+        if self.bed_mesh is not None:
+            self._bind_bed_mesh(self.bed_mesh.bmc)
+    def _bind_bed_mesh(self, bmc):
+        for parent in [bmc, getattr(bmc, 'probe_mgr', None)]:
+            for name in ['probe_helper', 'prb_helper']:
+                probe_helper = getattr(parent, name, None)
+                if hasattr(probe_helper, 'finalize_callback'):
+                    self.mesh_probe_helper = probe_helper
+                    break
+            if self.mesh_probe_helper is not None:
+                break
+        if hasattr(bmc, 'probe_mgr'):
+            probe_mgr = bmc.probe_mgr
+            self.get_mesh_zero_ref_pos = lambda: probe_mgr.zero_ref_pos
+        elif hasattr(bmc, 'zero_ref_pos'):
+            # TODO: remove - deprecated since 2024-06
+            self.get_mesh_zero_ref_pos = lambda: bmc.zero_ref_pos
+        elif hasattr(bmc, 'relative_reference_index'):
+            # TODO: remove: trying to read the deprecated rri
+            def get_rri_pos():
+                rri = bmc.relative_reference_index
+                if rri is None:
+                    return None
+                return bmc.points[rri]
+            self.get_mesh_zero_ref_pos = get_rri_pos
+    def get_probe_params(self):
+        probe = self.probe
+        # TODO: remove: deprecated since 2024-06-10
+        if hasattr(probe, 'sample_count'):
+            return {'samples': probe.sample_count,
+                    'samples_tolerance': probe.samples_tolerance,
+                    'samples_tolerance_retries': probe.samples_retries,
+                    'lift_speed': probe.lift_speed,
+                    'samples_result': probe.samples_result,
+                    'z_offset': probe.z_offset}
+        probe_params = dict(probe.get_probe_params())
+        probe_params['z_offset'] = probe.get_offsets()[2]
+        return probe_params
 class EndstopWrapper:
     def __init__(self, endstop):
         self.mcu_endstop = endstop
@@ -396,45 +1231,261 @@ class EndstopWrapper:
         self.home_start = self.mcu_endstop.home_start
         self.home_wait = self.mcu_endstop.home_wait
         self.query_endstop = self.mcu_endstop.query_endstop
+class RunningStats:
+    # Welford's streaming mean and variance with min/max and median
+    def __init__(self):
+        self.count = 0
+        self.mean = self.m2 = 0.
+        self.min_value = self.max_value = None
+        self.median = P2Quantile(.5)
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if self.max_value is None or value > self.max_value:
+            self.max_value = value
+        self.median.add(value)
+    def get_sigma(self):
+        if not self.count:
+            return 0.
+        return (self.m2 / self.count) ** 0.5
+class P2Quantile:
+    # streaming quantile estimation with the P-square algorithm, the
+    # first samples are kept to report the exact quantile for short runs
+    def __init__(self, quantile, exact_count=100):
+        self.quantile = quantile
+        self.exact_count = max(exact_count, 5)
+        self.samples = []
+        self.heights = None
+        self.positions = None
+        self.increments = [0., quantile / 2., quantile,
+                           (1. + quantile) / 2., 1.]
+    def _init_markers(self):
+        # place the five markers on the sorted samples
+        count = len(self.samples)
+        self.positions = [1. + round((count - 1) * inc)
+                          for inc in self.increments]
+        self.heights = [self.samples[int(pos) - 1] for pos in self.positions]
+        self.desired = [1. + (count - 1) * inc for inc in self.increments]
+        self.samples = None
+    def add(self, value):
+        if self.samples is not None:
+            bisect.insort(self.samples, value)
+            if len(self.samples) > self.exact_count:
+                self._init_markers()
+            return
+        # find the cell of the new value and adjust the extreme markers
+        heights = self.heights
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        pos = self.positions
+        for i in range(cell + 1, 5):
+            pos[i] += 1.
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        # move the middle markers towards their desired positions
+        for i in range(1, 4):
+            delta = self.desired[i] - pos[i]
+            if ((delta >= 1. and pos[i + 1] - pos[i] > 1.)
+                or (delta <= -1. and pos[i - 1] - pos[i] < -1.)):
+                d = 1. if delta > 0. else -1.
+                height = heights[i] + d / (pos[i + 1] - pos[i - 1]) * (
+                    (pos[i] - pos[i - 1] + d) * (heights[i + 1] - heights[i])
+                    / (pos[i + 1] - pos[i])
+                    + (pos[i + 1] - pos[i] - d) * (heights[i] - heights[i - 1])
+                    / (pos[i] - pos[i - 1]))
+                if not heights[i - 1] < height < heights[i + 1]:
+                    # parabolic prediction out of order, use linear
+                    j = i + int(d)
+                    height = heights[i] + d * (heights[j] - heights[i]) / (
+                        pos[j] - pos[i])
+                heights[i] = height
+                pos[i] += d
+    def get(self):
+        samples = self.samples
+        if samples is None:
+            return self.heights[2]
+        if not samples:
+            return 0.
+        index = self.quantile * (len(samples) - 1)
+        low = int(index)
+        high = min(low + 1, len(samples) - 1)
+        return samples[low] + (samples[high] - samples[low]) * (index - low)
+class HistoryWriter:
+    # appends the calibration results as json lines to a file, the file
+    # is written in a background thread to never block the reactor
+    def __init__(self, filename, max_size):
+        self.filename = filename
+        self.max_size = max_size
+        self.bg_queue = queue.Queue()
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def load(self, history):
+        # fill the ring buffer from the files, once at startup
+        for filename in [self.filename + '.1', self.filename]:
+            try:
+                with open(filename) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        if entry.get('offset') is not None:
+                            history.append(entry)
+            except (IOError, OSError):
+                pass
+    def add(self, entry):
+        self.bg_queue.put_nowait(json.dumps(entry, sort_keys=True,
+                                             separators=(',', ':')) + "\n")
+    def stop(self):
+        self.bg_queue.put_nowait(None)
+        self.bg_thread.join()
+    def _bg_thread(self):
+        while 1:
+            line = self.bg_queue.get(True)
+            if line is None:
+                break
+            self._write(line)
+    def _write(self, line):
+        try:
+            # rotate to a single backup file
+            if (os.path.exists(self.filename)
+                and os.path.getsize(self.filename) + len(line)
+                > self.max_size):
+                os.rename(self.filename, self.filename + '.1')
+            with open(self.filename, 'a') as f:
+                f.write(line)
+        except (IOError, OSError):
+            logging.exception("Unable to write z_calibration history")
+class RunStats:
+    def __init__(self, reactor, toolhead):
+        self.reactor = reactor
+        self.toolhead = toolhead
+        self.phases = {}
+        self.phase = None
+        self.taps = self.retries = self.rejected = self.moves = 0
+        self.start_time = self.phase_time = reactor.monotonic()
+        self.start_print_time = toolhead.get_last_move_time()
+        self.phase_print_time = self.start_print_time
+    def set_phase(self, phase):
+        # accumulate the wall and print time of the current phase
+        if phase == self.phase:
+            return
+        curtime = self.reactor.monotonic()
+        print_time = self.toolhead.get_last_move_time()
+        if self.phase is not None:
+            times = self.phases.setdefault(self.phase, [0., 0.])
+            times[0] += curtime - self.phase_time
+            times[1] += print_time - self.phase_print_time
+        self.phase = phase
+        self.phase_time = curtime
+        self.phase_print_time = print_time
+    def finish(self, success):
+        self.set_phase(None)
+        return {'success': success,
+                'duration': self.phase_time - self.start_time,
+                'print_duration': self.phase_print_time
+                                  - self.start_print_time,
+                'phases': dict([(name, {'duration': times[0],
+                                        'print_duration': times[1]})
+                                for name, times in self.phases.items()]),
+                'taps': self.taps,
+                'retries': self.retries,
+                'rejected': self.rejected,
+                'moves': self.moves}
 class CalibrationState:
     def __init__(self, helper, gcmd):
         self.helper = helper
         self.gcmd = gcmd
         self.gcode = helper.gcode
         self.z_endstop = helper.z_endstop
-        self.probe = helper.printer.lookup_object('probe')
-        self.toolhead = helper.printer.lookup_object('toolhead')
-        self.gcode_move = helper.printer.lookup_object('gcode_move')
+        self.adapter = helper.adapter
+        self.probe = self.adapter.probe
+        self.toolhead = self.adapter.toolhead
+        self.gcode_move = self.adapter.gcode_move
         self.max_deviation = helper.max_deviation
         self.offset_margins = helper.offset_margins
-    def _probe_on_site(self, endstop, site, check_probe=False, split_xy=False,
-                       wiggle=False):
-        pos = self.toolhead.get_position()
-        self.helper._move_safe_z(pos, self.helper.lift_speed)
-        # move to position
-        if split_xy:
-            self.helper._move([site[0], pos[1], None], self.helper.speed)
-            self.helper._move([site[0], site[1], site[2]], self.helper.speed)
-        else:
-            self.helper._move(site, self.helper.speed)
+        self.stats = RunStats(helper.reactor, self.toolhead)
+        helper.run_stats = self.stats
+        self.samples = helper.samples
+        self.sites = {}
+        self.probe_names = list(ACCURACY_SITES)
+    def _probe_on_site(self, name, endstop, site, check_probe=False,
+                       split_xy=False, wiggle=False, samples=()):
+        # samples might already be known (from homing), top them up
+        taps = list(samples)
+        positions = list(taps)
+        if (len(positions) >= self.samples
+            or self.helper._is_confident(positions)):
+            return self._get_site_result(name, positions)
+        self._move_to_site(site, split_xy)
         if check_probe:
-            # check if probe is attached and switch is closed
-            time = self.toolhead.get_last_move_time()
-            if self.probe.mcu_probe.query_endstop(time):
-                raise self.gcmd.error("%s: probe switch not closed - probe not"
-                                      " attached?" % (self.gcmd.get_command()))
-        if self.helper.first_fast:
+            self._check_probe_attached()
+        # with a known trigger height, move down quickly and probe only
+        # in a window around it
+        window_z = None
+        approach_z = self.helper._get_approach_z(name)
+        if approach_z is not None:
+            self.stats.set_phase('approach')
+            window_z = self._approach(name, endstop, approach_z)
+        elif self.helper.first_fast and not taps:
             # first probe just to get down faster
+            self.stats.set_phase('first_fast')
             self.helper._probe(self.gcmd, endstop, self.helper.position_min,
                                self.helper.probing_speed, wiggle=wiggle)
+        self.stats.set_phase('probing')
         retries = 0
-        positions = []
-        while len(positions) < self.helper.samples:
+        rejected = 0
+        while (len(positions) < self.samples
+               and not self.helper._is_confident(positions)):
+            if len(taps) >= self.helper.max_taps:
+                raise self.gcmd.error("%s: probe samples exceed tolerance"
+                                      " after %d taps"
+                                      % (self.gcmd.get_command(), len(taps)))
             # probe with second probing speed
-            curpos = self.helper._probe(self.gcmd, endstop,
-                                        self.helper.position_min,
-                                        self.helper.second_speed,
-                                        wiggle=wiggle)
+            try:
+                probe_z = window_z
+                if probe_z is None:
+                    probe_z = self.helper.position_min
+                curpos = self.helper._probe(self.gcmd, endstop, probe_z,
+                                            self.helper.second_speed,
+                                            wiggle=wiggle, previous=taps)
+            except self.helper.printer.command_error as e:
+                if window_z is None or "No trigger" not in str(e):
+                    raise
+                # fall back to a full descent
+                self.gcmd.respond_info("%s: no trigger near the expected"
+                                       " height at %s, probing the full"
+                                       " range..."
+                                       % (self.gcmd.get_command(), name))
+                window_z = None
+                continue
+            window_z = None
+            self._send_sample(name, curpos, retries)
+            taps.append(curpos[:3])
+            if self.helper.samples_result == 'mad':
+                # use only the consistent samples and top up the rest
+                positions = self.helper._reject_outliers(taps)
+                if len(taps) - len(positions) > rejected:
+                    rejected = len(taps) - len(positions)
+                    self.gcmd.respond_info("%s: probe samples exceed"
+                                           " tolerance. Rejected %d of %d"
+                                           " samples..."
+                                           % (self.gcmd.get_command(),
+                                              rejected, len(taps)))
+                continue
             positions.append(curpos[:3])
             # check tolerance
             z_positions = [p[2] for p in positions]
@@ -446,11 +1497,83 @@ class CalibrationState:
                                        " Retrying..."
                                        % (self.gcmd.get_command()))
                 retries += 1
+                self.stats.retries += 1
+                self.stats.set_phase('retries')
                 positions = []
+        if self.helper.samples_result == 'mad':
+            self.stats.rejected += len(taps) - len(positions)
+        return self._get_site_result(name, positions)
+    def _approach(self, name, endstop, approach_z):
+        # a guarded descent to the approach height, the site may have moved
+        # up since the last result, e.g. with a thicker bed plate
+        pos = self.toolhead.get_position()
+        window_z = approach_z - 2. * self.helper.approach_margin
+        if pos[2] <= approach_z:
+            return window_z
+        pos[2] = approach_z
+        try:
+            curpos = self.helper.adapter.probing_move(
+                endstop, pos, self.helper.probing_speed)
+        except self.helper.printer.command_error as e:
+            if "No trigger" not in str(e):
+                raise
+            return window_z
+        self.gcmd.respond_info("%s: %s triggered above the expected height,"
+                               " probing the full range..."
+                               % (self.gcmd.get_command(), name))
+        self.helper._move([None, None,
+                           curpos[2] + self.helper.retract_dist],
+                          self.helper.lift_speed)
+        return None
+    def _get_site_result(self, name, positions):
         # calculate result
-        if self.helper.samples_result == 'median':
-            return self.helper._calc_median(positions)[2]
-        return self.helper._calc_mean(positions)[2]
+        if self.helper.samples_result in ('median', 'mad'):
+            result = self.helper._calc_median(positions)[2]
+        else:
+            result = self.helper._calc_mean(positions)[2]
+        z_positions = [pos[2] for pos in positions]
+        spread = max(z_positions) - min(z_positions)
+        self.sites[name] = {'z': result, 'spread': spread,
+                            'samples': len(positions)}
+        self.helper._store_site_result(name, result, spread,
+                                       len(positions))
+        return result
+    def _send_sample(self, name, pos, retry):
+        self.helper._send_event('sample', {'command': self.gcmd.get_command(),
+                                           'site': name, 'x': pos[0],
+                                           'y': pos[1], 'z': pos[2],
+                                           'retry': retry})
+    def _move_to_site(self, site, split_xy=False, lift_speed=None):
+        # move to position, the plan is based on the current position
+        # since any gcode template might have moved the toolhead
+        self.stats.set_phase('travel')
+        pos = self.toolhead.get_position()
+        for coord, speed in self.helper._plan_travel(pos, site, split_xy,
+                                                     lift_speed):
+            self.helper._move(coord, speed)
+    def _query_probe_attached(self):
+        # the probe switch is closed if the probe is attached, the state
+        # is published for the gcode templates to skip needless docking
+        time = self.toolhead.get_last_move_time()
+        attached = not self.adapter.query_probe(time)
+        if attached != self.helper.probe_attached:
+            self.helper.probe_attached = attached
+            self.helper._update_status()
+        return attached
+    def _check_probe_attached(self):
+        # check if probe is attached and switch is closed
+        if not self._query_probe_attached():
+            raise self.gcmd.error("%s: probe switch not closed - probe not"
+                                  " attached?" % (self.gcmd.get_command()))
+    def _start_probe_session(self):
+        self.adapter.start_probe_session()
+    def _end_probe_session(self):
+        try:
+            self.adapter.end_probe_session()
+        except:
+            logging.exception("Multi-probe end")
+    def _get_probe_endstop(self):
+        return self.adapter.probe_endstop
     def _add_probe_offset(self, site):
         # calculate bed position by using the probe's offsets
         probe_offsets = self.probe.get_offsets()
@@ -458,6 +1581,11 @@ class CalibrationState:
         probe_site[0] -= probe_offsets[0]
         probe_site[1] -= probe_offsets[1]
         return probe_site
+    def _log_travel_plan(self, sites):
+        plan = self.helper._plan_sites(self.toolhead.get_position(), sites)
+        logging.info("%s: planned travel moves per site: %s"
+                     % (self.gcmd.get_command(),
+                        ", ".join([str(len(moves)) for moves in plan])))
     def _set_new_gcode_offset(self, offset):
         # reset gcode z offset to 0
         gcmd_offset = self.gcode.create_gcode_command("SET_GCODE_OFFSET",
@@ -469,86 +1597,252 @@ class CalibrationState:
                                                       "SET_GCODE_OFFSET",
                                                       {'Z_ADJUST': offset})
         self.gcode_move.cmd_SET_GCODE_OFFSET(gcmd_offset)
-    def calibrate_z(self, switch_offset, nozzle_site, switch_site, bed_site):
-        # execute start gcode
-        self.helper.start_gcode.run_gcode_from_command()
+    def _is_attached_first(self):
+        # with a before_nozzle_gcode to detach it, an already attached probe
+        # is used for the switch and the bed first
+        return (self.helper.nozzle_gcode is not None
+                and self._query_probe_attached())
+    def _reuse_site(self, name):
+        result = self.helper._get_site_result(self.gcmd, name)
+        self.gcmd.respond_info("%s: reusing the %s result z=%.6f"
+                               " (samples=%d, spread=%.6f, age=%.0fs)"
+                               % (self.gcmd.get_command(), name, result['z'],
+                                  result['samples'], result['spread'],
+                                  self.helper.reactor.monotonic()
+                                  - result['time']))
+        return result['z']
+    def _probe_sites(self, probe_nozzles, switch_site, probe_site,
+                     attached_first):
+        # the switch gcode is skipped if neither needs the attached probe
+        attached = ('switch' in self.probe_names
+                    or 'bed' in self.probe_names)
+        if not attached:
+            switch_zero = self._reuse_site('switch')
+            probe_zero = self._reuse_site('bed')
+        elif attached_first:
+            switch_zero, probe_zero = self._probe_switch_and_bed(switch_site,
+                                                                 probe_site)
+        if 'nozzle' not in self.probe_names:
+            nozzle_zeros = self._reuse_site('nozzle')
+        else:
+            if self.helper.nozzle_gcode is not None:
+                # execute nozzle gcode
+                self.stats.set_phase('nozzle_gcode')
+                self.helper.nozzle_gcode.run_gcode_from_command()
+                self._query_probe_attached()
+            nozzle_zeros = probe_nozzles()
+        if attached and not attached_first:
+            self._query_probe_attached()
+            switch_zero, probe_zero = self._probe_switch_and_bed(switch_site,
+                                                                 probe_site)
+        return nozzle_zeros, switch_zero, probe_zero
+    def _probe_switch_and_bed(self, switch_site, probe_site):
+        # execute switch gcode
+        self.stats.set_phase('switch_gcode')
+        self.helper.switch_gcode.run_gcode_from_command()
+        self._start_probe_session()
         try:
-            # probe the nozzle
-            nozzle_zero = self._probe_on_site(self.z_endstop,
-                                              nozzle_site,
-                                              check_probe=False,
-                                              split_xy=True,
-                                              wiggle=True)
-            # execute switch gcode
-            self.helper.switch_gcode.run_gcode_from_command()
-            # start probe session
-            # TODO: remove: deprecated since 2024-06-10
-            if hasattr(self.probe, 'multi_probe_begin'):
-                self.probe.multi_probe_begin()
+            # probe switch body
+            if 'switch' in self.probe_names:
+                switch_zero = self._probe_on_site('switch', self.z_endstop,
+                                                  switch_site,
+                                                  check_probe=True)
+            else:
+                switch_zero = self._reuse_site('switch')
+            # probe bed position, unless a fresh bed mesh already did
+            probe_zero = self.helper._get_mesh_probe_zero(probe_site)
+            if 'bed' not in self.probe_names:
+                probe_zero = self._reuse_site('bed')
+            elif probe_zero is None:
+                probe_zero = self._probe_on_site('bed',
+                                                 self._get_probe_endstop(),
+                                                 probe_site,
+                                                 check_probe=True)
             else:
-                self.probe.probe_session.start_probe_session(None)
+                self.sites['bed'] = {'z': probe_zero, 'spread': 0.,
+                                     'samples': 1}
+                self.helper._store_site_result('bed', probe_zero, 0., 1)
+                self.gcmd.respond_info("%s: using the bed mesh probe result"
+                                       " z=%.6f at %.3f,%.3f"
+                                       % (self.gcmd.get_command(), probe_zero,
+                                          probe_site[0], probe_site[1]))
+        finally:
+            self._end_probe_session()
+        return switch_zero, probe_zero
+    def _check_offset(self, offset, name=None):
+        prefix = self.gcmd.get_command()
+        if name is not None:
+            prefix = "%s: %s" % (prefix, name)
+        if abs(offset) > 0.2:
+            pos_z_estop = self.helper.position_z_endstop
+            new_pos_z_estop = pos_z_estop - offset
+            self.gcmd.respond_info("%s: current z axis position_endstop="
+                                   "%.3f - new offset=%.6f --> POSSIBLE"
+                                   " SUGGESTION: new z axis"
+                                   " position_endstop=%.3f"
+                                   % (prefix, pos_z_estop, offset,
+                                      new_pos_z_estop))
+        # check offset margins
+        # TODO: remove: max_deviation is deprecated
+        if (self.max_deviation is not None
+            and abs(offset) > self.max_deviation):
+            raise self.gcmd.error("%s: offset is greater than allowed:"
+                                  " offset=%.3f > max_deviation=%.3f"
+                                  % (prefix, offset, self.max_deviation))
+        elif (offset < self.offset_margins[0]
+              or offset > self.offset_margins[1]):
+            raise self.gcmd.error("%s: offset %.3f is outside the"
+                                  " configured range of min=%.3f and"
+                                  " max=%.3f"
+                                  % (prefix, offset, self.offset_margins[0],
+                                     self.offset_margins[1]))
+    def _probe_nozzle(self, nozzle_site):
+        samples = self.helper._get_homing_samples(nozzle_site)
+        if samples:
+            self.gcmd.respond_info("%s: using the z homing at %.3f,%.3f"
+                                   " as nozzle sample z=%.6f"
+                                   % (self.gcmd.get_command(),
+                                      samples[0][0], samples[0][1],
+                                      samples[0][2]))
+        return self._probe_on_site('nozzle', self.z_endstop, nozzle_site,
+                                   check_probe=False, split_xy=True,
+                                   wiggle=True, samples=samples)
+    def _measure_offset(self, switch_offset, nozzle_site, switch_site,
+                        probe_site):
+        attached_first = self._is_attached_first()
+        plan = [('nozzle', nozzle_site, True), ('switch', switch_site, False),
+                ('bed', probe_site, False)]
+        if attached_first:
+            plan = plan[1:] + plan[:1]
+        plan = [(site, split_xy) for name, site, split_xy in plan
+                if name in self.probe_names]
+        self._log_travel_plan(plan)
+        # probe the nozzle, the switch body and the bed
+        nozzle_zero, switch_zero, probe_zero = self._probe_sites(
+            lambda: self._probe_nozzle(nozzle_site), switch_site,
+            probe_site, attached_first)
+        # calculate the offset
+        offset = probe_zero - (switch_zero - nozzle_zero + switch_offset)
+        # print result
+        self.gcmd.respond_info("%s: bed_probe=%.3f - (switch=%.3f"
+                               " - nozzle=%.3f + switch_offset=%.3f) -->"
+                               " new_offset=%.6f"
+                               % (self.gcmd.get_command(), probe_zero,
+                                  switch_zero, nozzle_zero, switch_offset,
+                                  offset))
+        return offset
+    def _verify_offset(self, switch_offset, nozzle_site, switch_site,
+                       probe_site):
+        # a single tap per site, accepted if it confirms the last offset
+        self.samples = 1
+        try:
+            offset = self._measure_offset(switch_offset, nozzle_site,
+                                          switch_site, probe_site)
+        finally:
+            self.samples = self.helper.samples
+        deviation = offset - self.helper.last_z_offset
+        if abs(deviation) > self.helper.verify_tolerance:
+            self.gcmd.respond_info("%s: offset deviates by %.6f from the last"
+                                   " offset=%.6f, calibrating..."
+                                   % (self.gcmd.get_command(), deviation,
+                                      self.helper.last_z_offset))
+            return None
+        self.gcmd.respond_info("%s: verified the last offset=%.6f"
+                               " (deviation=%.6f)"
+                               % (self.gcmd.get_command(),
+                                  self.helper.last_z_offset, deviation))
+        return offset
+    def _detach_for_nozzle(self):
+        # the switch gcode left the probe attached, without a
+        # before_nozzle_gcode only the end gcode detaches it before the
+        # nozzle is probed again
+        if (self.helper.nozzle_gcode is not None
+            or 'nozzle' not in self.probe_names):
+            return
+        self.stats.set_phase('end_gcode')
+        self.helper.end_gcode.run_gcode_from_command()
+        self.stats.set_phase('start_gcode')
+        self.helper.start_gcode.run_gcode_from_command()
+        self._query_probe_attached()
+    def _wait_for_soak(self, switch_site, probe_site):
+        # single taps at the switch body and the bed until their distance
+        # stops drifting while the printer heats through
+        helper = self.helper
+        command = self.gcmd.get_command()
+        start_time = helper.reactor.monotonic()
+        readings = []
+        self.stats.set_phase('switch_gcode')
+        helper.switch_gcode.run_gcode_from_command()
+        while 1:
+            reading_time = helper.reactor.monotonic()
+            self.samples = 1
+            self._start_probe_session()
             try:
-                # probe switch body
-                switch_zero = self._probe_on_site(self.z_endstop,
+                switch_zero = self._probe_on_site('switch', self.z_endstop,
                                                   switch_site,
                                                   check_probe=True)
-                # probe bed position
-                probe_site = self._add_probe_offset(bed_site)
-                # TODO: remove: deprecated since 2026-05-25
-                # Klipper's probe refactor nests the real MCU endstop inside
-                # ProbeEndstopWrapper, which itself no longer exposes
-                # get_steppers/home_start/etc. Unwrap when needed.
-                probe_endstop = self.probe.mcu_probe
-                if not hasattr(probe_endstop, 'get_steppers'):
-                    probe_endstop = probe_endstop.mcu_endstop
-                probe_zero = self._probe_on_site(probe_endstop,
+                probe_zero = self._probe_on_site('bed',
+                                                 self._get_probe_endstop(),
                                                  probe_site,
                                                  check_probe=True)
             finally:
-                # end probe session
-                try:
-                    # TODO: remove: deprecated since 2024-06-10
-                    if hasattr(self.probe, 'multi_probe_end'):
-                        self.probe.multi_probe_end()
-                    else:
-                        self.probe.probe_session.end_probe_session()
-                except:
-                    logging.exception("Multi-probe end")
-            # calculate the offset
-            offset = probe_zero - (switch_zero - nozzle_zero + switch_offset)
-            # print result
-            self.gcmd.respond_info("%s: bed_probe=%.3f - (switch=%.3f"
-                                   " - nozzle=%.3f + switch_offset=%.3f) -->"
-                                   " new_offset=%.6f"
-                                   % (self.gcmd.get_command(), probe_zero,
-                                      switch_zero, nozzle_zero, switch_offset,
-                                      offset))
-            if abs(offset) > 0.2:
-                pos_z_estop = self.helper.position_z_endstop
-                new_pos_z_estop = pos_z_estop - offset
-                self.gcmd.respond_info("%s: current z axis position_endstop="
-                                       "%.3f - new offset=%.6f --> POSSIBLE"
-                                       " SUGGESTION: new z axis"
-                                       " position_endstop=%.3f"
-                                       % (self.gcmd.get_command(),
-                                          pos_z_estop, offset,
-                                          new_pos_z_estop))
-            # check offset margins
-            # TODO: remove: max_deviation is deprecated
-            if (self.max_deviation is not None
-                and abs(offset) > self.max_deviation):
-                raise self.gcmd.error("%s: offset is greater than allowed:"
-                                      " offset=%.3f > max_deviation=%.3f"
-                                      % (self.gcmd.get_command(), offset,
-                                         self.max_deviation))
-            elif (offset < self.offset_margins[0]
-                  or offset > self.offset_margins[1]):
-                raise self.gcmd.error("%s: offset %.3f is outside the"
-                                      " configured range of min=%.3f and"
-                                      " max=%.3f"
-                                      % (self.gcmd.get_command(), offset,
-                                         self.offset_margins[0],
-                                         self.offset_margins[1]))
+                self._end_probe_session()
+                self.samples = helper.samples
+            readings.append((reading_time, probe_zero - switch_zero))
+            readings = readings[-helper.soak_window:]
+            elapsed = helper.reactor.monotonic() - start_time
+            if len(readings) < helper.soak_window:
+                self.gcmd.respond_info("%s: soak reading %d: bed-switch=%.6f"
+                                       % (command, len(readings),
+                                          readings[-1][1]))
+            else:
+                # drift in mm per minute
+                drift = 60. * helper._calc_slope(
+                    [reading[0] for reading in readings],
+                    [reading[1] for reading in readings])
+                self.gcmd.respond_info("%s: soak reading: bed-switch=%.6f,"
+                                       " drift=%.6f/min"
+                                       % (command, readings[-1][1], drift))
+                if abs(drift) <= helper.soak_threshold:
+                    self.gcmd.respond_info("%s: stable after %.0fs"
+                                           % (command, elapsed))
+                    return
+            if elapsed >= helper.soak_timeout:
+                self.gcmd.respond_info("%s: not stable after %.0fs,"
+                                       " calibrating anyway"
+                                       % (command, elapsed))
+                return
+            # lift off the bed and wait for the next reading
+            self.stats.set_phase('soak')
+            helper._move_safe_z(self.toolhead.get_position(),
+                                helper.lift_speed)
+            self.toolhead.wait_moves()
+            helper.reactor.pause(reading_time + helper.soak_interval)
+            if helper.printer.is_shutdown():
+                raise self.gcmd.error("%s: printer shutdown while soaking"
+                                      % (command,))
+    def calibrate_z(self, switch_offset, nozzle_site, switch_site, bed_site,
+                    verify=False, soak=False, sites=ACCURACY_SITES):
+        probe_site = self._add_probe_offset(bed_site)
+        self.probe_names = list(sites)
+        self._query_probe_attached()
+        # execute start gcode
+        self.stats.set_phase('start_gcode')
+        self.helper.start_gcode.run_gcode_from_command()
+        try:
+            if soak:
+                self._wait_for_soak(switch_site, probe_site)
+                self._detach_for_nozzle()
+            offset = None
+            if verify:
+                offset = self._verify_offset(switch_offset, nozzle_site,
+                                             switch_site, probe_site)
+                if offset is None:
+                    self._detach_for_nozzle()
+            if offset is None:
+                offset = self._measure_offset(switch_offset, nozzle_site,
+                                              switch_site, probe_site)
+            self._check_offset(offset)
             # set new offset
             self._set_new_gcode_offset(offset)
             # set states
@@ -556,6 +1850,145 @@ class CalibrationState:
             self.helper.last_z_offset = offset
         finally:
             # execute end gcode
+            self.stats.set_phase('end_gcode')
+            self.helper.end_gcode.run_gcode_from_command()
+    def calibrate_tools(self, tools, switch_site, bed_site):
+        # the bed and the switch body are probed only once for all tools
+        probe_site = self._add_probe_offset(bed_site)
+        self._query_probe_attached()
+        # execute start gcode
+        self.stats.set_phase('start_gcode')
+        self.helper.start_gcode.run_gcode_from_command()
+        try:
+            # probe the nozzle of every tool, the switch body and the bed
+            nozzle_zeros, switch_zero, probe_zero = self._probe_sites(
+                lambda: self._probe_tool_nozzles(tools), switch_site,
+                probe_site, self._is_attached_first())
+            # calculate the offsets
+            offsets = {}
+            for (tool, nozzle_site, switch_offset), nozzle_zero in zip(
+                    tools, nozzle_zeros):
+                offset = probe_zero - (switch_zero - nozzle_zero
+                                       + switch_offset)
+                self.gcmd.respond_info("%s: %s: bed_probe=%.3f - (switch=%.3f"
+                                       " - nozzle=%.3f + switch_offset=%.3f)"
+                                       " --> new_offset=%.6f"
+                                       % (self.gcmd.get_command(), tool.name,
+                                          probe_zero, switch_zero,
+                                          nozzle_zero, switch_offset, offset))
+                self._check_offset(offset, tool.name)
+                offsets[tool.name] = offset
+            # set states
+            self.helper.tool_offsets.update(offsets)
+            self.helper.last_state = True
+        finally:
+            # execute end gcode
+            self.stats.set_phase('end_gcode')
             self.helper.end_gcode.run_gcode_from_command()
+    def _probe_tool_nozzles(self, tools):
+        nozzle_zeros = []
+        for tool, nozzle_site, switch_offset in tools:
+            self.stats.set_phase('select_gcode')
+            tool.select_gcode.run_gcode_from_command()
+            nozzle_zeros.append(self._probe_on_site('nozzle ' + tool.name,
+                                                    self.z_endstop,
+                                                    nozzle_site,
+                                                    check_probe=False,
+                                                    split_xy=True,
+                                                    wiggle=True))
+        return nozzle_zeros
+    def probe_accuracy(self, sites, samples, speeds, lift_speed,
+                       retract_dist, target_sigma, batch, report):
+        # sites is a list of (name, site): the nozzle is probed first,
+        # then the switch and the bed interleaved in batches of samples,
+        # each of them for all speeds. The result is a list of
+        # (name, speed, stats).
+        results = []
+        nozzle = [(name, site) for name, site in sites if name == 'nozzle']
+        attached = [(name, site) for name, site in sites if name != 'nozzle']
+        if nozzle:
+            for speed in speeds:
+                results += self._probe_sites_accuracy(
+                    nozzle, samples, speed, lift_speed, retract_dist,
+                    target_sigma, batch, report)
+        if attached:
+            self._query_probe_attached()
+            self.helper.switch_gcode.run_gcode_from_command()
+            try:
+                self._start_probe_session()
+                try:
+                    for speed in speeds:
+                        results += self._probe_sites_accuracy(
+                            attached, samples, speed, lift_speed,
+                            retract_dist, target_sigma, batch, report)
+                finally:
+                    self._end_probe_session()
+            finally:
+                self.helper.end_gcode.run_gcode_from_command()
+        return results
+    def _probe_sites_accuracy(self, sites, samples, speed, lift_speed,
+                              retract_dist, target_sigma, batch, report):
+        command = self.gcmd.get_command()
+        visits = []
+        for name, site in sites:
+            endstop = self.z_endstop
+            if name == 'bed':
+                endstop = self._get_probe_endstop()
+                site = self._add_probe_offset(site)
+            visits.append((name, site, endstop, RunningStats()))
+        pending = list(visits)
+        while pending:
+            for visit in list(pending):
+                name, site, endstop, stats = visit
+                self._move_to_site(site, split_xy=(name == 'nozzle'),
+                                   lift_speed=lift_speed)
+                if name != 'nozzle':
+                    self._check_probe_attached()
+                if not stats.count:
+                    pos = self.toolhead.get_position()
+                    self.gcmd.respond_info("%s at X:%.3f Y:%.3f Z:%.3f"
+                                           " (samples=%d retract=%.3f"
+                                           " speed=%.1f lift_speed=%.1f)\n"
+                                           % (command, pos[0], pos[1],
+                                              pos[2], samples, retract_dist,
+                                              speed, lift_speed))
+                for i in range(batch):
+                    # probe position
+                    pos = self.helper._probe(self.gcmd, endstop,
+                                             self.helper.position_min, speed)
+                    stats.add(pos[2])
+                    self._send_sample(name, pos, 0)
+                    # retract
+                    self.helper._move([None, None, pos[2] + retract_dist],
+                                      lift_speed)
+                    if report and stats.count % report == 0:
+                        self.gcmd.respond_info(
+                            "%s: %s: %d samples, average %.6f,"
+                            " median %.6f, range %.6f,"
+                            " standard deviation %.6f"
+                            % (command, name, stats.count, stats.mean,
+                               stats.median.get(),
+                               stats.max_value - stats.min_value,
+                               stats.get_sigma()))
+                    if (stats.count >= samples
+                        or (target_sigma and stats.count >= MIN_SIGMA_SAMPLES
+                            and stats.get_sigma() <= target_sigma)):
+                        pending.remove(visit)
+                        break
+        return [(name, speed, stats)
+                for name, site, endstop, stats in visits]
+class ZCalibrationTool:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.name = config.get_name().split()[-1]
+        helper = self.printer.load_object(config, 'z_calibration')
+        self.nozzle_site = helper._get_xy("nozzle_xy_position", True, config)
+        self.switch_offset = config.getfloat('switch_offset', None, above=0.)
+        gcode_macro = self.printer.load_object(config, 'gcode_macro')
+        self.select_gcode = gcode_macro.load_template(config, 'select_gcode',
+                                                      '')
+        helper.register_tool(self)
 def load_config(config):
     return ZCalibrationHelper(config)
+def load_config_prefix(config):
+    return ZCalibrationTool(config)